@@ -0,0 +1,417 @@
+# Lastmessung für den UptimeBot ohne echte Server und ohne echtes Telegram.
+#
+# Startet einen lokalen SSH-Server (paramiko), der unter beliebig vielen Adressen aus
+# 127.0.0.0/8 als eigener Host antwortet (uptime, docker ps, df, docker logs, Prune-Skript,
+# Probe-Skript), mit einstellbarer Latenz und Fehlerrate, dazu eine Attrappe der
+# Telegram-Bot-API. Dagegen laufen CheckScheduler + periodic_check_server und /s für alle Server.
+#
+#   python benchmark.py --hosts 10,100,1000 --duration 30 --interval 10
+#
+# Jede Flottengröße läuft in einem eigenen Prozess, damit Speicher und Zustände getrennt
+# bleiben; die Fake-Hosts laufen daneben in einem eigenen Prozess. Beide teilen sich die
+# CPUs der Maschine: absolute Zahlen sind damit pessimistisch, für den Vergleich zweier
+# Stände mit gleichem --seed aber reproduzierbar.
+import os
+import sys
+import json
+import time
+import base64
+import random
+import shlex
+import socket
+import logging
+import argparse
+import asyncio
+import resource
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+import urllib.parse
+from types import SimpleNamespace
+import paramiko
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+CHAT_ID = 1
+
+def host_ip(index):
+    # 127.1.0.1, 127.1.0.2, ... – alles in 127.0.0.0/8 landet auf lo
+    return f"127.1.{index // 250}.{index % 250 + 1}"
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+# === Fake-SSH-Hosts ===
+class FakeHost:
+    def __init__(self, ip, rng):
+        self.ip = ip
+        self.boot = time.time() - rng.uniform(3600, 30 * 86400)
+        self.used = rng.randint(10, 90)
+        self.log_seq = 0
+
+    def log_lines(self, count):
+        lines = []
+        for _ in range(count):
+            self.log_seq += 1
+            ts = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()) + f".{time.time_ns() % 10**9:09d}Z"
+            lines.append(f"{ts} step {self.log_seq} loss={random.random():.4f}")
+        return "\n".join(lines)
+
+    def probe(self, script):
+        var = {}
+        for line in script.split("\n", 6)[:5]:
+            key, _, value = line.partition("=")
+            var[key] = value.strip("'")
+        b64 = lambda text: base64.b64encode(text.encode()).decode()
+        size = 100 * 2**30
+        used = size * self.used // 100
+        data = {
+            "uptime_seconds": round(time.time() - self.boot, 2),
+            "load": [round(random.uniform(0, 4), 2) for _ in range(3)],
+            "uptime_text": b64(f" {time.strftime('%H:%M:%S')} up 3 days,  1 user,  load average: 0.10, 0.20, 0.30"),
+            "disk": [size, used, size - used, self.used],
+            "disk_text": b64(f"Filesystem Size Used Avail Use% Mounted on\n/dev/vdb 100G {self.used}G {100 - self.used}G {self.used}% /mnt"),
+            "docker_ps": b64("CONTAINER ID   IMAGE     STATUS\nabc123   trainer   Up 3 days"),
+        }
+        if var.get("ps_all") == "1":
+            data["containers"] = [{"Names": "trainer", "State": "running", "Status": "Up 3 days"}]
+        if var.get("c"):
+            data["logs"] = b64(self.log_lines(3 if var.get("since") else 20))
+        return json.dumps(data)
+
+    def run(self, command):
+        if command.startswith("timeout "):
+            # Der Bot startet jedes Kommando als: timeout -k N T sh -c '<skript>'
+            command = shlex.split(command)[-1]
+        if "/proc/uptime" in command:
+            return self.probe(command)
+        if command.startswith("docker logs"):
+            return self.log_lines(20)
+        if command.startswith("uptime"):
+            return " 12:00:00 up 3 days,  1 user,  load average: 0.10, 0.20, 0.30"
+        if command.startswith("ls"):
+            return "total 8\ndrwxr-xr-x 2 root root 4.0K step_1\ndrwxr-xr-x 2 root root 4.0K step_2"
+        return ""
+
+class FakeSSHServer(paramiko.ServerInterface):
+    def __init__(self, host, latency, fail_rate):
+        self.host = host
+        self.latency = latency
+        self.fail_rate = fail_rate
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._exec, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+    def _exec(self, channel, command):
+        try:
+            time.sleep(random.expovariate(1 / self.latency) if self.latency else 0)
+            if random.random() < self.fail_rate:
+                channel.close()  # Abbruch ohne Ausgabe, wie ein hängender oder abgestürzter Befehl
+                return
+            channel.sendall(self.host.run(command).encode())
+            channel.send_exit_status(0)
+        except Exception:
+            pass
+        finally:
+            channel.close()
+
+def start_fake_hosts(hosts, port, host_key, latency, fail_rate, offline):
+    # Ein Listener für alle: der Host ergibt sich aus der Zieladresse der Verbindung
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(1024)
+
+    def handle(conn):
+        host = hosts.get(conn.getsockname()[0])
+        if host is None or host.ip in offline:
+            conn.close()
+            return
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key)
+        try:
+            transport.start_server(server=FakeSSHServer(host, latency, fail_rate))
+        except Exception:
+            transport.close()
+
+    def accept_loop():
+        while True:
+            conn, _ = sock.accept()
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+    return sock
+
+# === Fake-Telegram-API ===
+class FakeTelegram:
+    def __init__(self, latency, throttle_rate):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.message_id = 0
+        self.calls = {}
+        self.throttled = 0
+
+    def result(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        self.message_id += 1
+        return {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", CHAT_ID)), "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                length = next((int(l.split(":", 1)[1]) for l in lines if l.lower().startswith("content-length:")), 0)
+                body = await reader.readexactly(length) if length else b""
+                method = lines[0].split(" ")[1].rstrip("/").rsplit("/", 1)[-1]
+                params = {k: v[0] for k, v in urllib.parse.parse_qs(body.decode()).items()}
+                if not params and body:
+                    params = json.loads(body)
+                self.calls[method] = self.calls.get(method, 0) + 1
+                if self.latency:
+                    await asyncio.sleep(random.expovariate(1 / self.latency))
+                if method != "getMe" and random.random() < self.throttle_rate:
+                    self.throttled += 1
+                    payload = {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                               "parameters": {"retry_after": 1}}
+                    status = "429 Too Many Requests"
+                else:
+                    payload = {"ok": True, "result": self.result(method, params)}
+                    status = "200 OK"
+                data = json.dumps(payload).encode()
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+# === Ein Lauf mit n Hosts (im eigenen Prozess) ===
+class LoopMonitor:
+    # Misst, wie lange die Event-Loop blockiert war: Verspätung eines 10-ms-Timers
+    def __init__(self, tick=0.01):
+        self.tick = tick
+        self.delays = []
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.tick)
+            self.delays.append(max(0.0, loop.time() - start - self.tick))
+
+def fleet(args):
+    rng = random.Random(args.seed)
+    hosts = {host_ip(i): FakeHost(host_ip(i), rng) for i in range(args.run)}
+    offline = set(rng.sample(sorted(hosts), int(len(hosts) * args.offline)))
+    return hosts, offline
+
+def serve_fake_hosts(args, key_path, ready):
+    # Banner-Vorprüfungen des Bots trennen vor dem Handshake, das ist hier kein Fehler
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+    random.seed(args.seed)
+    hosts, offline = fleet(args)
+    start_fake_hosts(hosts, args.port, paramiko.Ed25519Key(filename=key_path), args.latency, args.fail_rate, offline)
+    ready.set()
+    threading.Event().wait()
+
+def run_single(args):
+    workdir = tempfile.mkdtemp(prefix="uptimebot-bench-")
+    key = Ed25519PrivateKey.generate()
+    key_path = os.path.join(workdir, "id_ed25519")
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH,
+                                  serialization.NoEncryption()))
+    # Fake-Hosts in einem eigenen Prozess, sonst konkurrieren ihre Threads mit dem Bot um den GIL
+    ctx = multiprocessing.get_context("fork")
+    ready = ctx.Event()
+    hosts_proc = ctx.Process(target=serve_fake_hosts, args=(args, key_path, ready), daemon=True)
+    hosts_proc.start()
+    if not ready.wait(30):
+        raise RuntimeError("Fake-Hosts sind nicht gestartet")
+    try:
+        return asyncio.run(measure(args, workdir, key_path))
+    finally:
+        hosts_proc.terminate()
+
+async def measure(args, workdir, key_path):
+    fake_tg = FakeTelegram(args.tg_latency, args.tg_throttle)
+    tg_server = await asyncio.start_server(fake_tg.handle, "127.0.0.1", 0)
+    tg_port = tg_server.sockets[0].getsockname()[1]
+    os.environ.update(
+        TELEGRAM_TOKEN="1:bench", TELEGRAM_CHAT_ID=str(CHAT_ID), SSH_USERNAME="bench",
+        PRIVATE_KEY_PATH=key_path, SSH_PORT=str(args.port), ADAPTIVE_INTERVALS="0",
+    )
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import uptimebot as bot
+    from telegram import Bot, Update
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)  # Offline-Hosts sollen die Ausgabe nicht fluten
+
+    hosts, _ = fleet(args)
+    bot.set_settings({"servers": {
+        ip: {"name": f"bench-{i}", "container": "trainer", "interval": args.interval}
+        for i, ip in enumerate(hosts)
+    }})
+
+    tg = Bot("1:bench", base_url=f"http://127.0.0.1:{tg_port}/bot")
+    await tg.initialize()
+    bot.outbox = bot.Outbox(tg)
+    baseline_rss = rss_mb()
+
+    cycles = []
+
+    async def timed_check(app, ip):
+        start = time.perf_counter()
+        await bot.periodic_check_server(app, ip)
+        cycles.append(time.perf_counter() - start)
+
+    monitor = LoopMonitor()
+    monitor_task = asyncio.create_task(monitor.run())
+    history_task = asyncio.create_task(bot.metrics_history.run())
+    if args.workers:
+        bot.check_workers = bot.CheckWorkers(args.workers)
+        bot.check_workers.start()
+    bot.check_scheduler = bot.CheckScheduler(None, timed_check, bot.CHECK_CONCURRENCY * max(1, args.workers))
+    for ip in hosts:
+        bot.check_scheduler.add(ip)
+    started = time.perf_counter()
+    bot.check_scheduler.start()
+    await asyncio.sleep(args.duration)
+    await bot.check_scheduler.stop()
+    elapsed = time.perf_counter() - started
+    probe_delays = list(monitor.delays)
+
+    # /s ! für die ganze Flotte, Antworten gehen über die Fake-API
+    message = {"message_id": 1, "date": int(time.time()), "text": "/s !",
+               "chat": {"id": CHAT_ID, "type": "private"}}
+    update = Update.de_json({"update_id": 1, "message": message}, tg)
+    monitor.delays.clear()
+    start = time.perf_counter()
+    await bot.s_command(update, SimpleNamespace(args=["!"]))
+    fleet_seconds = time.perf_counter() - start
+    fleet_delays = list(monitor.delays)
+
+    outbox_depth = bot.outbox.depth
+    monitor_task.cancel()
+    history_task.cancel()
+    await bot.outbox.close()
+    if bot.check_workers:
+        await bot.check_workers.stop()
+    await tg.shutdown()
+    tg_server.close()
+
+    expected = len(hosts) * args.duration / args.interval
+    blocked = [d for d in probe_delays if d > 0.005]
+    return {
+        "hosts": len(hosts),
+        "workers": args.workers,
+        "checks": len(cycles),
+        "checks_expected": round(expected),
+        "throughput": len(cycles) / elapsed,
+        "cycle_p50": percentile(cycles, 50),
+        "cycle_p99": percentile(cycles, 99),
+        "scheduler_lag": bot.check_scheduler.lag,
+        "loop_block_max": max(probe_delays, default=0.0),
+        "loop_block_total": sum(blocked),
+        "loop_block_share": sum(blocked) / elapsed,
+        "fleet_s_seconds": fleet_seconds,
+        "fleet_loop_block_max": max(fleet_delays, default=0.0),
+        "outbox_depth": outbox_depth,
+        "outbox_throttled": bot.outbox.throttled,
+        "telegram_calls": sum(fake_tg.calls.values()),
+        "rss_mb": rss_mb(),
+        "rss_delta_mb": rss_mb() - baseline_rss,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+# === Auswertung über mehrere Flottengrößen ===
+COLUMNS = [
+    ("hosts", "Hosts", "{:d}"),
+    ("workers", "Worker", "{:d}"),
+    ("checks", "Checks", "{:d}"),
+    ("checks_expected", "Soll", "{:d}"),
+    ("throughput", "Checks/s", "{:.1f}"),
+    ("cycle_p50", "p50 s", "{:.3f}"),
+    ("cycle_p99", "p99 s", "{:.3f}"),
+    ("loop_block_max", "Block max s", "{:.3f}"),
+    ("loop_block_share", "Block %", "{:.1%}"),
+    ("fleet_s_seconds", "/s ! s", "{:.2f}"),
+    ("outbox_depth", "Outbox", "{:d}"),
+    ("rss_mb", "RSS MB", "{:.0f}"),
+]
+
+def print_table(results):
+    rows = [[fmt.format(r[key]) for key, _, fmt in COLUMNS] for r in results]
+    widths = [max(len(title), *(len(row[i]) for row in rows)) for i, (_, title, _) in enumerate(COLUMNS)]
+    print("  ".join(title.rjust(w) for (_, title, _), w in zip(COLUMNS, widths)))
+    for row in rows:
+        print("  ".join(cell.rjust(w) for cell, w in zip(row, widths)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Lastmessung gegen lokale Fake-Hosts und Fake-Telegram-API")
+    parser.add_argument("--hosts", default="10,100,1000", help="Flottengrößen, kommagetrennt")
+    parser.add_argument("--duration", type=float, default=30, help="Sekunden Scheduler-Betrieb pro Größe")
+    parser.add_argument("--interval", type=int, default=10, help="Prüfintervall pro Server in Sekunden")
+    parser.add_argument("--latency", type=float, default=0.05, help="mittlere Antwortzeit der Fake-Hosts")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Anteil abgebrochener Kommandos")
+    parser.add_argument("--offline", type=float, default=0.0, help="Anteil Hosts ohne sshd")
+    parser.add_argument("--tg-latency", type=float, default=0.02, help="mittlere Antwortzeit der Fake-API")
+    parser.add_argument("--tg-throttle", type=float, default=0.0, help="Anteil Antworten mit 429")
+    parser.add_argument("--workers", type=int, default=0, help="CHECK_WORKERS für den Bot")
+    parser.add_argument("--port", type=int, default=2222, help="Port der Fake-Hosts")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="Ergebnisse zusätzlich als JSON in diese Datei schreiben")
+    parser.add_argument("--run", type=int, help=argparse.SUPPRESS)  # intern: ein Lauf im Kindprozess
+    args = parser.parse_args()
+
+    if args.run is not None:
+        result = run_single(args)
+        sys.stdout.write("\n" + json.dumps(result) + "\n")
+        sys.stdout.flush()
+        os._exit(0)  # Paramiko-Threads der Fake-Hosts nicht abwarten
+
+    results = []
+    for n in (int(x) for x in args.hosts.split(",")):
+        cmd = [sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--run", str(n)]
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, text=True)
+        if proc.returncode != 0:
+            sys.exit(f"Lauf mit {n} Hosts fehlgeschlagen (Exit {proc.returncode})")
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+        print(f"{n} Hosts: {results[-1]['checks']} Checks, p99 {results[-1]['cycle_p99']:.3f} s", file=sys.stderr)
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,34 @@
 import os
 import json
+import atexit
+import tempfile
+import sqlite3
+import logging
 import re
+import shlex
+import base64
+import socket
+import time
+import heapq
+import random
+import itertools
+import zlib
+import gzip
+import fnmatch
+import hashlib
+import bisect
+import signal
+import select
+import multiprocessing
+import collections
 import asyncio
+import threading
+from dataclasses import dataclass, field, asdict, astuple
 import paramiko
-from telegram.ext import Application, CommandHandler, ContextTypes
+from concurrent.futures import ThreadPoolExecutor
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, TimedOut
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, ContextTypes
 from dotenv import load_dotenv
 
 # === Load environment and constants ===
@@ -15,339 +40,1670 @@ PRIVATE_KEY_PATH = os.getenv("PRIVATE_KEY_PATH")
 SETTINGS_FILE = "out/settings.txt"  # Default settings file path
 
 # === Settings logic (multi-server, each with name/settings, interval pro Server) ===
+SETTINGS_FLUSH_DELAY = float(os.getenv("SETTINGS_FLUSH_DELAY", "1"))  # Sekunden bis Änderungen geschrieben werden
+SETTINGS_RELOAD = os.getenv("SETTINGS_RELOAD", "0") == "1"  # settings.txt neu laden, wenn sie extern geändert wurde
+SETTINGS_RELOAD_CHECK = 5  # Sekunden zwischen mtime-Prüfungen
+
+# Hält settings.txt im Speicher. Lesen kostet keinen Dateizugriff, Änderungen werden
+# gesammelt und nach flush_delay Sekunden atomar (Temp-Datei + rename) geschrieben.
+class SettingsStore:
+    def __init__(self, path, flush_delay=SETTINGS_FLUSH_DELAY, reload=SETTINGS_RELOAD):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.reload = reload
+        self._lock = threading.RLock()
+        self._data = None
+        self._mtime = None
+        self._checked = 0.0
+        self._dirty = False
+        self._timer = None
+        self.version = 0  # steigt bei jeder Änderung, z.B. für die Indizes der ServerRegistry
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            mtime = os.stat(self.path).st_mtime_ns
+            migrated = self._migrate(data)
+        except FileNotFoundError:
+            if self._data is not None:
+                return
+            data, mtime, migrated = {"servers": {}}, None, True
+        except Exception as e:
+            if self._data is None:
+                raise RuntimeError(f"settings: {self.path} ist nicht lesbar: {e}") from e
+            # z.B. Editor mitten im Schreiben: alten Stand behalten, beim nächsten Check erneut versuchen
+            logging.warning("settings: %s nicht lesbar, behalte bisherigen Stand: %s", self.path, e)
+            return
+        self._data = data
+        self._mtime = mtime
+        self.version += 1
+        if migrated:
+            self._mark_dirty()
+
+    @staticmethod
+    def _migrate(data):
+        # Alte Versionen haben Container zusätzlich unter "ips" gespeichert (doppelte
+        # get_container/set_container). Die "ips"-Werte waren die wirksamen.
+        changed = "servers" not in data
+        servers = data.setdefault("servers", {})
+        for ip, legacy in (data.pop("ips", None) or {}).items():
+            changed = True
+            if ip in servers and legacy.get("container"):
+                servers[ip]["container"] = legacy["container"]
+        return changed
+
+    def _check_reload(self):
+        now = time.monotonic()
+        if not self.reload or self._dirty or now - self._checked < SETTINGS_RELOAD_CHECK:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._mtime:
+            logging.info("settings: %s wurde extern geändert, lade neu", self.path)
+            self._load()
+
+    @property
+    def data(self):
+        with self._lock:
+            if self._data is None:
+                self._load()
+            else:
+                self._check_reload()
+            return self._data
+
+    def _mark_dirty(self):
+        self.version += 1
+        self._dirty = True
+        if self._timer is None:
+            self._timer = threading.Timer(self.flush_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def replace(self, data):
+        with self._lock:
+            self._data = data
+            self._migrate(data)
+            self._mark_dirty()
+
+    def set_value(self, key, value):
+        with self._lock:
+            self.data[key] = value
+            self._mark_dirty()
+
+    def set_server(self, ip, data):
+        with self._lock:
+            self.data["servers"][ip] = data
+            self._mark_dirty()
+
+    def set_server_value(self, ip, key, value):
+        with self._lock:
+            self.data["servers"].setdefault(ip, {})[key] = value
+            self._mark_dirty()
+
+    def delete_server(self, ip):
+        with self._lock:
+            removed = self.data["servers"].pop(ip, None)
+            self._mark_dirty()
+            return removed
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            payload = json.dumps(self._data)
+            dirpath = os.path.dirname(self.path)
+            if dirpath:
+                os.makedirs(dirpath, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=dirpath or ".", prefix=".settings.")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.write(payload)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            self._mtime = os.stat(self.path).st_mtime_ns
+            self._dirty = False
+
+settings_store = SettingsStore(SETTINGS_FILE)
+atexit.register(settings_store.flush)
+
 def get_settings():
-    try:
-        with open(SETTINGS_FILE, "r") as f:
-            return json.load(f)
-    except Exception:
-        settings = {
-            "servers": {}
-        }
-        set_settings(settings)
-        return settings
+    return settings_store.data
 
 def set_settings(settings):
-    dirpath = os.path.dirname(SETTINGS_FILE)
-    if dirpath:
-        os.makedirs(dirpath, exist_ok=True)
-    with open(SETTINGS_FILE, "w") as f:
-        json.dump(settings, f)
+    settings_store.replace(settings)
 
 def get_server(ip):
-    s = get_settings()
-    return s.get("servers", {}).get(ip)
+    return get_all_servers().get(ip)
 
 def set_server(ip, data):
-    s = get_settings()
-    if "servers" not in s:
-        s["servers"] = {}
-    s["servers"][ip] = data
-    set_settings(s)
+    settings_store.set_server(ip, data)
 
 def set_server_value(ip, key, value):
-    s = get_settings()
-    if "servers" not in s:
-        s["servers"] = {}
-    if ip not in s["servers"]:
-        s["servers"][ip] = {}
-    s["servers"][ip][key] = value
-    set_settings(s)
+    settings_store.set_server_value(ip, key, value)
 
 def get_server_value(ip, key, default=None):
-    s = get_settings()
-    return s.get("servers", {}).get(ip, {}).get(key, default)
+    return get_all_servers().get(ip, {}).get(key, default)
 
 def get_all_servers():
-    return get_settings().get("servers", {})
+    return get_settings()["servers"]
 
-# Kompatibilität: Container für IP
-def get_container(ip=None):
+def get_container(ip):
     return get_server_value(ip, "container")
 
 def set_container(ip, container):
     set_server_value(ip, "container", container)
 
-def get_container(ip):
-    return get_settings().get("ips", {}).get(ip, {}).get("container")
 
-def set_container(ip, container):
-    s = get_settings()
-    if "ips" not in s:
-        s["ips"] = {}
-    if ip not in s["ips"]:
-        s["ips"][ip] = {}
-    s["ips"][ip]["container"] = container
-    set_settings(s)
+# === Server-Registry ===
+# Indizes über die Server aus dem SettingsStore nach Name, Container und Tag (Gruppe + Tags).
+# Sie werden neu aufgebaut, sobald sich die Einstellungen ändern; Lookups sind danach O(1).
+SELECTOR_CHARS = "@*?[,"
+CONTAINER_SELECTOR = "container:"
+
+class ServerRecord:
+    __slots__ = ("ip", "name", "container", "group", "tags")
+
+    def __init__(self, ip, srv):
+        self.ip = ip
+        self.name = srv.get("name", ip)
+        self.container = srv.get("container")
+        self.group = srv.get("group")
+        self.tags = tuple(srv.get("tags", ()))
+
+    @property
+    def labels(self):
+        return ((self.group,) if self.group else ()) + self.tags
+
+class ServerRegistry:
+    def __init__(self, store):
+        self._store = store
+        self._version = None
+        self._by_ip = {}
+        self._by_name = {}
+        self._by_container = {}
+        self._by_tag = {}
+
+    def _index(self):
+        servers = self._store.data["servers"]
+        if self._version == self._store.version:
+            return
+        by_ip, by_name, by_container, by_tag = {}, {}, {}, {}
+        for ip, srv in servers.items():
+            rec = ServerRecord(ip, srv)
+            by_ip[ip] = rec
+            by_name.setdefault(rec.name, rec)
+            if rec.container:
+                by_container.setdefault(rec.container, []).append(rec)
+            for label in rec.labels:
+                by_tag.setdefault(label, []).append(rec)
+        self._by_ip, self._by_name, self._by_container, self._by_tag = by_ip, by_name, by_container, by_tag
+        self._version = self._store.version
+
+    def all(self):
+        self._index()
+        return list(self._by_ip.values())
+
+    def get(self, ip):
+        self._index()
+        return self._by_ip.get(ip)
+
+    def find(self, name):
+        # Name, ersatzweise IP
+        self._index()
+        return self._by_name.get(name) or self._by_ip.get(name)
+
+    def resolve(self, selector):
+        # "name" oder IP, "@tag" (Gruppe oder Tag), "stage1-*" (Glob auf Namen),
+        # "container:trainer" (gesetzter Container), mehrere mit Komma
+        self._index()
+        found = {}
+        for part in filter(None, selector.split(",")):
+            if part.startswith("@"):
+                matches = self._by_tag.get(part[1:], ())
+            elif part.startswith(CONTAINER_SELECTOR):
+                matches = self._by_container.get(part[len(CONTAINER_SELECTOR):], ())
+            elif any(ch in part for ch in "*?["):
+                matches = [rec for name, rec in self._by_name.items() if fnmatch.fnmatchcase(name, part)]
+            else:
+                rec = self.find(part)
+                matches = (rec,) if rec else ()
+            for rec in matches:
+                found.setdefault(rec.ip, rec)
+        return list(found.values())
+
+server_registry = ServerRegistry(settings_store)
+
+def valid_server_name(name):
+    return (bool(name) and not name.startswith(("@", CONTAINER_SELECTOR))
+            and not any(ch in name for ch in SELECTOR_CHARS + " "))
+
+async def find_server_ip(update, name):
+    rec = server_registry.find(name)
+    if not rec:
+        await reply(update, f"Kein VServer mit Name '{name}' gefunden.")
+        return None
+    return rec.ip
+
+async def resolve_servers(update, selector):
+    records = server_registry.resolve(selector)
+    if not records:
+        await reply(update, f"Kein VServer für '{selector}' gefunden.")
+    return records
+
+def describe_servers(records):
+    if len(records) == 1:
+        return f"{records[0].name} ({records[0].ip})"
+    return f"{len(records)} Server: " + ", ".join(rec.name for rec in records)
+
+
+# === Metriken (OpenMetrics) ===
+# Zähler, Gauges und Histogramme im Speicher; der Exporter weiter unten liefert sie per HTTP
+# aus, wenn METRICS_PORT gesetzt ist. Ohne Exporter kostet das Mitzählen praktisch nichts.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+metric_families = []
+
+class Metric:
+    kind = "unknown"
+
+    def __init__(self, name, help_text, labels=(), collect=None):
+        # collect: Funktion, die beim Abruf [(labelwerte, wert), ...] liefert, statt selbst zu zählen
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._collect = collect
+        self._values = {}
+        self._lock = threading.Lock()
+        metric_families.append(self)
+
+    def remove(self, *labels):
+        with self._lock:
+            for key in [k for k in self._values if k[:len(labels)] == labels]:
+                del self._values[key]
+
+    def samples(self):
+        # [(suffix, {label: wert}, wert), ...]
+        if self._collect:
+            return [("", dict(zip(self.labels, key)), value) for key, value in self._collect()]
+        with self._lock:
+            return [("", dict(zip(self.labels, key)), value) for key, value in self._values.items()]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        return [("_total", labels, value) for _, labels, value in super().samples()]
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * len(self.buckets) + [0, 0.0]  # Buckets, count, sum
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        out = []
+        for key, counts in values:
+            labels = dict(zip(self.labels, key))
+            for bound, count in zip(self.buckets, counts):
+                out.append(("_bucket", {**labels, "le": bound}, count))
+            out.append(("_bucket", {**labels, "le": float("inf")}, counts[-2]))
+            out.append(("_count", labels, counts[-2]))
+            out.append(("_sum", labels, counts[-1]))
+        return out
+
+ssh_connect_seconds = Histogram("uptimebot_ssh_connect_seconds", "Dauer von TCP-Connect, Handshake und Auth", ["host"])
+ssh_connect_failures = Counter("uptimebot_ssh_connect_failures", "Fehlgeschlagene SSH-Verbindungsaufbauten", ["host"])
+ssh_exec_seconds = Histogram("uptimebot_ssh_exec_seconds", "Laufzeit einzelner SSH-Kommandos", ["host", "command"])
+probe_results = Counter("uptimebot_probes", "Ergebnisse periodischer Checks", ["host", "outcome"])
+probe_stage_timeouts = Counter("uptimebot_probe_stage_timeouts", "Probe-Stufen mit Fristüberschreitung", ["host", "stage"])
+prune_deleted_dirs = Counter("uptimebot_prune_deleted_dirs", "Durch Pruning gelöschte Checkpoint-Verzeichnisse", ["host"])
+scheduler_lag_seconds = Histogram("uptimebot_scheduler_lag_seconds", "Verspätung eines Checks gegenüber seinem Termin",
+                                  buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+
+
+# === SSH connection pool ===
+SSH_CONNECT_TIMEOUT = 5
+SSH_PORT = int(os.getenv("SSH_PORT", "22"))
+SSH_KEEPALIVE = int(os.getenv("SSH_KEEPALIVE", "30"))  # Sekunden zwischen Keepalive-Paketen
+SSH_IDLE_TIMEOUT = int(os.getenv("SSH_IDLE_TIMEOUT", "600"))  # Idle-Verbindungen nach X Sekunden schließen
+
+_ssh_key = None
+_ssh_key_lock = threading.Lock()
+
+def get_ssh_key():
+    # Key nur einmal von der Platte lesen und parsen
+    global _ssh_key
+    with _ssh_key_lock:
+        if _ssh_key is None:
+            _ssh_key = paramiko.Ed25519Key.from_private_key_file(PRIVATE_KEY_PATH)
+        return _ssh_key
+
+# Hält pro Host eine authentifizierte SSH-Verbindung offen. Jedes Kommando bekommt nur
+# einen neuen Channel auf dem bestehenden Transport. Tote Verbindungen werden per Keepalive
+# erkannt und beim nächsten Kommando neu aufgebaut, unbenutzte Hosts nach idle_timeout geschlossen.
+# Hosts mit offenen Channels (z.B. docker events, logs -f) gelten nie als unbenutzt.
+class SSHPool:
+
+    def __init__(self, keepalive=SSH_KEEPALIVE, idle_timeout=SSH_IDLE_TIMEOUT):
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self._clients = {}
+        self._last_used = {}
+        self._channels = collections.Counter()  # ip -> offene Channels, Rückgabe über release()
+        self._host_locks = {}
+        self._lock = threading.Lock()
+
+    def _host_lock(self, ip):
+        with self._lock:
+            return self._host_locks.setdefault(ip, threading.Lock())
+
+    def _connect(self, ip):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        start = time.monotonic()
+        try:
+            ssh.connect(ip, port=SSH_PORT, username=SSH_USERNAME, pkey=get_ssh_key(), timeout=SSH_CONNECT_TIMEOUT,
+                        allow_agent=False, look_for_keys=False)
+        except Exception:
+            ssh_connect_failures.inc(ip)
+            raise
+        ssh_connect_seconds.observe(time.monotonic() - start, ip)
+        ssh.get_transport().set_keepalive(self.keepalive)
+        return ssh
+
+    def get(self, ip):
+        # Liefert einen aktiven Transport, baut bei Bedarf neu auf
+        self.close_idle()
+        with self._host_lock(ip):
+            ssh = self._clients.get(ip)
+            transport = ssh.get_transport() if ssh else None
+            if transport is None or not transport.is_active():
+                if ssh:
+                    ssh.close()
+                ssh = self._connect(ip)
+                self._clients[ip] = ssh
+            self._last_used[ip] = time.monotonic()
+            return ssh.get_transport()
+
+    def is_connected(self, ip):
+        ssh = self._clients.get(ip)
+        transport = ssh.get_transport() if ssh else None
+        return transport is not None and transport.is_active()
+
+    def drop(self, ip):
+        with self._host_lock(ip):
+            ssh = self._clients.pop(ip, None)
+            self._last_used.pop(ip, None)
+        if ssh:
+            ssh.close()
+
+    def open_channel(self, ip):
+        # Ein Retry: eine vom Server still geschlossene Verbindung fällt erst beim Öffnen auf
+        for attempt in range(2):
+            transport = self.get(ip)
+            try:
+                chan = transport.open_session(timeout=SSH_CONNECT_TIMEOUT)
+            except (paramiko.SSHException, EOFError, OSError):
+                self.drop(ip)
+                if attempt:
+                    raise
+                continue
+            with self._lock:
+                self._channels[ip] += 1
+            return chan
+
+    def release(self, ip, chan):
+        # Gegenstück zu open_channel
+        chan.close()
+        with self._lock:
+            self._channels[ip] -= 1
+            if self._channels[ip] <= 0:
+                del self._channels[ip]
+
+    def close_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            idle = [ip for ip, ts in self._last_used.items() if now - ts > self.idle_timeout and not self._channels[ip]]
+        for ip in idle:
+            self.drop(ip)
+
+    def close_all(self):
+        for ip in list(self._clients):
+            self.drop(ip)
+
+ssh_pool = SSHPool()
 
 
 # === SSH helpers ===
 def ssh_uptime(ip):
-    key = paramiko.Ed25519Key.from_private_key_file(PRIVATE_KEY_PATH)
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(ip, username=SSH_USERNAME, pkey=key, timeout=5)
-    stdin, stdout, stderr = ssh.exec_command('uptime')
-    output = stdout.read().decode().strip()
-    ssh.close()
+    output, _ = ssh_command(ip, 'uptime')
     return output
 
-# Hilfsfunktion für beliebige SSH-Kommandos
-def ssh_command(ip, command):
-    key = paramiko.Ed25519Key.from_private_key_file(PRIVATE_KEY_PATH)
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(ip, username=SSH_USERNAME, pkey=key, timeout=5)
-    stdin, stdout, stderr = ssh.exec_command(command)
-    output = stdout.read().decode().strip()
-    error = stderr.read().decode().strip()
-    ssh.close()
+SSH_BANNER_TIMEOUT = float(os.getenv("SSH_BANNER_TIMEOUT", "2"))
+
+def ssh_banner(ip, timeout=SSH_BANNER_TIMEOUT):
+    # Stufe 1 der Prüfung: nur TCP-Connect und SSH-Banner lesen, ohne Handshake und Key-Auth
+    with socket.create_connection((ip, SSH_PORT), timeout=timeout) as sock:
+        data = b""
+        while b"\n" not in data and len(data) < 256:
+            chunk = sock.recv(256)
+            if not chunk:
+                break
+            data += chunk
+    banner = data.split(b"\n", 1)[0].strip()
+    if not banner.startswith(b"SSH-"):
+        raise RuntimeError(f"Kein SSH-Banner: {banner[:60].decode(errors='replace') or 'Verbindung geschlossen'}")
+    return banner.decode(errors="replace")
+
+# Hilfsfunktion für beliebige SSH-Kommandos; kind benennt das Kommando in den Metriken
+# Jedes Kommando läuft auf dem Host unter timeout(1), das bei Fristablauf die ganze Prozessgruppe
+# beendet (nach SSH_KILL_GRACE Sekunden per KILL). Antwortet der Host auch danach nicht, gibt der
+# Bot die Verbindung auf. stdout und stderr werden gemeinsam gelesen, damit kein voller Puffer blockiert.
+SSH_COMMAND_TIMEOUT = float(os.getenv("SSH_COMMAND_TIMEOUT", "30"))
+SSH_KILL_GRACE = 2
+TIMEOUT_EXIT_CODES = (124, 137)  # timeout(1): Frist abgelaufen bzw. per KILL beendet
+
+class CommandTimeout(RuntimeError):
+    def __init__(self, kind, timeout, output="", error=""):
+        super().__init__(f"{kind}: keine Antwort nach {timeout:g} Sekunden")
+        self.output = output  # bis zum Abbruch gelesene Ausgabe
+        self.error = error
+
+def ssh_command(ip, command, kind=None, timeout=None):
+    timeout = timeout or SSH_COMMAND_TIMEOUT
+    kind = kind or command.split(None, 1)[0]
+    chan = ssh_pool.open_channel(ip)
+    start = time.monotonic()
+    deadline = start + timeout + SSH_KILL_GRACE + 1
+    out, err = [], []
+    try:
+        chan.exec_command(f"timeout -k {SSH_KILL_GRACE} {timeout:g} sh -c {shlex.quote(command)}")
+        # poll statt select: bei großen Flotten liegen die Pipe-fds des Channels über 1024
+        ready = select.poll()
+        ready.register(chan.fileno(), select.POLLIN)
+        while True:
+            while chan.recv_ready():
+                out.append(chan.recv(65536))
+            while chan.recv_stderr_ready():
+                err.append(chan.recv_stderr(65536))
+            left = deadline - time.monotonic()
+            if chan.eof_received or chan.closed or left <= 0:
+                break
+            ready.poll(left * 1000)
+        # Was zwischen letztem Lesen und EOF ankam
+        while chan.recv_ready():
+            out.append(chan.recv(65536))
+        while chan.recv_stderr_ready():
+            err.append(chan.recv_stderr(65536))
+        stalled = not (chan.eof_received or chan.closed)
+        status = chan.exit_status if not stalled and chan.status_event.wait(max(0.1, min(1.0, deadline - time.monotonic()))) else None
+    finally:
+        ssh_pool.release(ip, chan)
+    ssh_exec_seconds.observe(time.monotonic() - start, ip, kind)
+    output = b"".join(out).decode(errors="replace").strip()
+    error = b"".join(err).decode(errors="replace").strip()
+    if stalled:
+        # Host hängt: Verbindung verwerfen, der nächste Aufruf baut neu auf
+        ssh_pool.drop(ip)
+        raise CommandTimeout(kind, timeout, output, error)
+    if status in TIMEOUT_EXIT_CODES:
+        raise CommandTimeout(kind, timeout, output, error)
     return output, error
 
 
-# === Prune output folders if /dev/vdb < 20G free ===
-def prune_output_folders(ip):
-    # Führt das Pruning-Skript per SSH aus
-    script = r'''
-avail=$(df -BG /dev/vdb | awk 'NR==2{gsub("G","",$4); print $4}')
-if [ "$avail" -lt 20 ]; then
-  cd /mnt/output || exit 1
-  keep_steps=$(ls -1d stage1_*step_* 2>/dev/null | grep -v '_encoder$' | sed -n 's/.*_step_\([0-9]*\)$/\1/p' | sort -n | tail -2)
-  keep_dirs=""
-  for step in $keep_steps; do
-    keep_dirs="$keep_dirs $(ls -d stage1_*step_${step} 2>/dev/null)"
-    keep_dirs="$keep_dirs $(ls -d stage1_*step_${step}_encoder 2>/dev/null)"
-  done
-  for d in stage1_*step_*; do
-    [ ! -d "$d" ] && continue
-    skip=0
-    for k in $keep_dirs; do
-      [ "$d" = "$k" ] && skip=1
-    done
-    [ $skip -eq 0 ] && rm -rf "$d"
-  done
+# === Async SSH execution ===
+# Paramiko ist synchron: alle SSH-Aufrufe laufen in einem begrenzten Thread-Pool,
+# damit Telegram-Polling und andere Checks nicht blockiert werden.
+SSH_MAX_CONCURRENCY = int(os.getenv("SSH_MAX_CONCURRENCY", "16"))
+ssh_executor = ThreadPoolExecutor(max_workers=SSH_MAX_CONCURRENCY, thread_name_prefix="ssh")
+
+async def run_ssh(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(ssh_executor, func, *args)
+
+def run_in_thread(func, *args):
+    # Eigener Thread statt ssh_executor, damit langlebige Streams keine Check-Slots belegen
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+
+    def settle(setter, value):
+        if not fut.done():
+            setter(value)
+
+    def target():
+        try:
+            result = func(*args)
+        except BaseException as e:
+            loop.call_soon_threadsafe(settle, fut.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(settle, fut.set_result, result)
+
+    threading.Thread(target=target, daemon=True).start()
+    return fut
+
+
+# === Pruning alter Checkpoints ===
+# Ausgelöst über den freien Platz, den die Probe ohnehin meldet, mit Cooldown pro Host.
+# Der Plan entsteht lokal aus einer einzigen Verzeichnisliste: behalten werden die neuesten
+# PRUNE_KEEP_STEPS Steps (samt _encoder), alle älteren stage1_*_step_N[_encoder] werden gelöscht.
+PRUNE_DIR = os.getenv("PRUNE_DIR", "/mnt/output")
+PRUNE_MIN_FREE_GB = float(os.getenv("PRUNE_MIN_FREE_GB", "20"))  # Pruning, wenn weniger frei ist
+PRUNE_KEEP_STEPS = int(os.getenv("PRUNE_KEEP_STEPS", "2"))
+PRUNE_COOLDOWN = float(os.getenv("PRUNE_COOLDOWN", "600"))  # Sekunden zwischen automatischen Läufen pro Host
+PRUNE_BATCH_CHARS = 100000  # max. Länge eines rm/du-Kommandos
+PRUNE_PREVIEW_LINES = 30  # Verzeichnisse in der Vorschau von /prune <name> dry
+PRUNE_TIMEOUT = float(os.getenv("PRUNE_TIMEOUT", "600"))  # Frist je rm/du-Kommando
+PRUNE_CONCURRENCY = int(os.getenv("PRUNE_CONCURRENCY", "2"))  # gleichzeitige Pruning-Läufe
+# Eigene, kleine Threads: ein rm -rf kann minutenlang laufen und soll dem ssh_executor
+# (Probes, /s, /logs) keine Threads wegnehmen
+prune_executor = ThreadPoolExecutor(max_workers=PRUNE_CONCURRENCY, thread_name_prefix="prune")
+
+async def run_prune(ip, dry=False):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(prune_executor, prune_output_folders, ip, dry)
+
+CHECKPOINT_RE = re.compile(r"^stage1_.*_step_(\d+)(_encoder)?$")
+# Nur Shell-Builtins: kein ls/grep/sed/sort pro Lauf
+LIST_CHECKPOINTS = 'cd {dir} || exit 1\nfor d in stage1_*step_*; do [ -d "$d" ] && printf "%s\\n" "$d"; done; exit 0'
+
+def plan_prune(names, keep_steps=PRUNE_KEEP_STEPS):
+    # Liefert (behalten, löschen). Namen, die nicht dem Checkpoint-Schema entsprechen, bleiben unangetastet.
+    checkpoints = []
+    steps = set()
+    for name in names:
+        m = CHECKPOINT_RE.match(name)
+        if m:
+            step = int(m.group(1))
+            checkpoints.append((name, step))
+            if not m.group(2):
+                steps.add(step)
+    keep_set = set(heapq.nlargest(keep_steps, steps))
+    keep, delete = [], []
+    for name, step in checkpoints:
+        (keep if step in keep_set else delete).append(name)
+    return keep, delete
+
+def _batches(names):
+    batch, length = [], 0
+    for name in names:
+        quoted = shlex.quote(name)
+        if batch and length + len(quoted) > PRUNE_BATCH_CHARS:
+            yield batch
+            batch, length = [], 0
+        batch.append(quoted)
+        length += len(quoted) + 1
+    if batch:
+        yield batch
+
+def prune_output_folders(ip, dry=False):
+    # Gibt (behalten, löschen, Bytes) zurück; Bytes nur bei dry (du über die Löschkandidaten)
+    out, err = ssh_command(ip, LIST_CHECKPOINTS.format(dir=shlex.quote(PRUNE_DIR)), "prune")
+    if err:
+        raise RuntimeError(err)
+    keep, delete = plan_prune(out.splitlines())
+    freed = None
+    if dry:
+        freed = 0
+        for batch in _batches(delete):
+            out, _ = ssh_command(ip, f"cd {shlex.quote(PRUNE_DIR)} && du -sb -- {' '.join(batch)}", "prune", PRUNE_TIMEOUT)
+            freed += sum(int(line.split("\t", 1)[0]) for line in out.splitlines() if line[:1].isdigit())
+        return keep, delete, freed
+    for batch in _batches(delete):
+        _, err = ssh_command(ip, f"cd {shlex.quote(PRUNE_DIR)} && rm -rf -- {' '.join(batch)}", "prune", PRUNE_TIMEOUT)
+        if err:
+            raise RuntimeError(err)
+    return keep, delete, freed
+
+last_prune = {}
+
+def needs_prune(ip, snap, now=None):
+    # Nur bei wenig freiem Platz und höchstens einmal pro PRUNE_COOLDOWN
+    if snap.disk_avail is None or snap.disk_avail >= PRUNE_MIN_FREE_GB * 2**30:
+        return False
+    now = time.monotonic() if now is None else now
+    if now - last_prune.get(ip, -PRUNE_COOLDOWN) < PRUNE_COOLDOWN:
+        return False
+    last_prune[ip] = now
+    return True
+
+prune_tasks = set()
+
+async def auto_prune(ip, name):
+    try:
+        keep, delete, _ = await run_prune(ip)
+    except Exception as e:
+        logging.warning("Pruning auf %s fehlgeschlagen: %s", name, e)
+        return
+    prune_deleted_dirs.inc(ip, amount=len(delete))
+    logging.info("Pruning auf %s: %d Verzeichnisse gelöscht, %d behalten", name, len(delete), len(keep))
+
+def format_bytes(value):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(value) < 1024:
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} TiB"
+
+
+# === Batched probe ===
+# Ein einziges Skript pro Check statt uptime/docker ps/df/logs einzeln.
+# Freitext wird base64-kodiert, damit die Ausgabe immer gültiges JSON ist.
+DISK_DEVICE = os.getenv("DISK_DEVICE", "/dev/vdb")
+DISK_WARN_PERCENT = 80
+LOG_TAIL_LINES = 20
+PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT", "20"))  # Frist für die ganze Probe
+PROBE_STAGE_TIMEOUT = int(os.getenv("PROBE_STAGE_TIMEOUT", "8"))  # Frist je Stufe (df, docker ps, ...)
+
+# Jede Stufe läuft mit eigener Frist, alle zusammen höchstens $budget Sekunden. Abgelaufene
+# Stufen stehen in "timed_out", die Felder der übrigen Stufen bleiben gültig.
+PROBE_SCRIPT = r"""
+b64() { base64 | tr -d '\n'; }
+read t0 rest < /proc/uptime; t0=${t0%.*}
+to=""
+stage() {
+  name=$1 errs=$2; shift 2
+  read now rest < /proc/uptime
+  left=$((t0 + budget - ${now%.*}))
+  [ "$left" -gt "$stage_timeout" ] && left=$stage_timeout
+  if [ "$left" -gt 0 ]; then
+    if [ "$errs" = 1 ]; then res=$(timeout -k 1 "$left" "$@" 2>&1); else res=$(timeout -k 1 "$left" "$@" 2>/dev/null); fi
+    rc=$?
+  else
+    res="" rc=124
+  fi
+  if [ "$rc" = 124 ] || [ "$rc" = 137 ]; then to="$to${to:+,}\"$name\""; return 1; fi
+}
+read up idle < /proc/uptime
+read l1 l5 l15 rest < /proc/loadavg
+printf '{"uptime_seconds":%s,"load":[%s,%s,%s]' "$up" "$l1" "$l5" "$l15"
+printf ',"uptime_text":"%s"' "$(uptime | b64)"
+if stage disk 0 df -P -B1; then
+  printf ',"disk":[%s]' "$(printf '%s\n' "$res" | awk -v d="$dev" '$1==d{sub("%","",$5); print $2","$3","$4","$5; exit}')"
+fi
+if stage disk_text 0 df -h; then
+  printf ',"disk_text":"%s"' "$(printf '%s\n' "$res" | awk -v d="$dev" 'NR==1{print;next} $1==d{print;exit}' | b64)"
 fi
-'''
-    # Führe das Skript aus
-    out, err = ssh_command(ip, script)
-    return out, err
+if stage docker_ps 1 docker ps; then
+  printf ',"docker_ps":"%s"' "$(printf '%s\n' "$res" | b64)"
+fi
+if [ "$ps_all" = 1 ] && stage containers 0 docker ps -a --format '{{json .}}'; then
+  printf ',"containers":[%s]' "$(printf '%s\n' "$res" | paste -sd, -)"
+fi
+if [ -n "$c" ] && stage logs 1 docker logs --timestamps --tail "$tail" ${since:+--since "$since"} "$c"; then
+  printf ',"logs":"%s"' "$(printf '%s\n' "$res" | b64)"
+fi
+printf ',"timed_out":[%s]}\n' "$to"
+"""
+
+@dataclass
+class Snapshot:
+    ip: str
+    taken_at: float
+    latency: float
+    uptime_seconds: float
+    load: tuple
+    uptime_text: str
+    docker_ps: str
+    containers: dict = field(default_factory=dict)  # Name -> State (running, exited, ...)
+    containers_listed: bool = True  # False, wenn docker ps -a übersprungen wurde (docker-events-Watch)
+    disk_size: int | None = None
+    disk_used: int | None = None
+    disk_avail: int | None = None
+    disk_percent: int | None = None
+    disk_text: str = ""
+    container: str | None = None
+    logs: str | None = None
+    timed_out: tuple = ()  # Probe-Stufen, die ihre Frist überschritten haben
+
+    def container_running(self, name):
+        return self.containers.get(name) == "running"
+
+def _b64(value):
+    return base64.b64decode(value or "").decode(errors="replace").strip()
+
+def parse_probe(ip, container, raw, latency):
+    data = json.loads(raw)
+    containers = {}
+    for c in data.get("containers", []):
+        # Ältere Docker-Versionen liefern kein "State"
+        state = c.get("State") or ("running" if c.get("Status", "").startswith("Up") else "exited")
+        for n in c.get("Names", "").split(","):
+            containers[n] = state
+    disk = data.get("disk") or [None] * 4
+    return Snapshot(
+        ip=ip,
+        taken_at=time.time(),
+        latency=latency,
+        uptime_seconds=float(data["uptime_seconds"]),
+        load=tuple(data["load"]),
+        uptime_text=_b64(data.get("uptime_text")),
+        docker_ps=_b64(data.get("docker_ps")),
+        containers=containers,
+        containers_listed="containers" in data,
+        disk_size=disk[0],
+        disk_used=disk[1],
+        disk_avail=disk[2],
+        disk_percent=disk[3],
+        disk_text=_b64(data.get("disk_text")),
+        container=container,
+        logs=_b64(data["logs"]) if "logs" in data else None,
+        timed_out=tuple(data.get("timed_out", ())),
+    )
+
+def probe_server(ip, container=None, list_containers=True):
+    cursor = get_log_cursor(ip, container) if container else None
+    # Mit Cursor nur neue Zeilen, aber alle davon, damit der Puffer lückenlos bleibt
+    tail = LOG_FETCH_LINES if cursor and cursor.since else LOG_TAIL_LINES
+    script = (
+        f"dev={shlex.quote(DISK_DEVICE)}\nc={shlex.quote(container or '')}\ntail={tail}\n"
+        f"since={shlex.quote(cursor.since or '') if cursor else ''}\nps_all={int(list_containers)}\n"
+        f"stage_timeout={PROBE_STAGE_TIMEOUT}\nbudget={max(1, int(PROBE_TIMEOUT) - SSH_KILL_GRACE - 1)}\n" + PROBE_SCRIPT
+    )
+    start = time.monotonic()
+    out, err = ssh_command(ip, script, "probe", PROBE_TIMEOUT)
+    try:
+        snap = parse_probe(ip, container, out, time.monotonic() - start)
+    except (ValueError, KeyError) as e:
+        raise RuntimeError(f"Ungültige Probe-Antwort: {err or e}")
+    if cursor and snap.logs is not None:
+        # Nur neue Zeilen kommen über die Leitung, der Tail stammt aus dem Cursor-Puffer
+        if cursor.feed(snap.logs) is not None:
+            snap.logs = cursor.tail(LOG_TAIL_LINES)
+    return snap
+
+class HostUnreachable(Exception):
+    pass
+
+def check_probe(ip, container=None, list_containers=True):
+    # Probe für periodische Checks: ohne offene Verbindung erst billig prüfen, ob überhaupt ein sshd antwortet
+    if not ssh_pool.is_connected(ip):
+        try:
+            ssh_banner(ip)
+        except Exception as e:
+            raise HostUnreachable(e) from e
+    return probe_server(ip, container, list_containers)
+
+
+# === Log-Cursor ===
+# Pro Server und Container merkt sich der Cursor den letzten Zeitstempel aus
+# "docker logs --timestamps" und hält die letzten Zeilen im Speicher. Folgeabrufe holen
+# mit --since nur neue Zeilen; --since ist inklusiv, daher werden Zeilen mit genau
+# diesem Zeitstempel dedupliziert.
+LOG_BUFFER_LINES = 2000
+LOG_FETCH_LINES = 2000
+LOG_LINE_RE = re.compile(r"^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?Z (.*)$")
+
+class LogCursor:
+    __slots__ = ("since", "since_key", "at_since", "lines", "seeded", "lock")
+
+    def __init__(self):
+        self.seeded = False  # Puffer enthält einen vollen LOG_FETCH_LINES-Tail, nicht nur den Probe-Tail
+        self.since = None
+        self.since_key = None
+        self.at_since = set()
+        self.lines = collections.deque(maxlen=LOG_BUFFER_LINES)
+        self.lock = threading.Lock()
+
+    def feed(self, output):
+        # Gibt die neuen Zeilen (ohne Zeitstempel) zurück, None wenn output keine Log-Zeilen enthält
+        parsed = []
+        for raw in output.splitlines():
+            m = LOG_LINE_RE.match(raw.rstrip("\r"))
+            if m:
+                # Docker kürzt Nullen am Ende der Nanosekunden, daher auf 9 Stellen normalisieren
+                parsed.append(((m.group(1), (m.group(2) or "").ljust(9, "0")), raw.split(" ", 1)[0], m.group(3)))
+        if not parsed and output.strip():
+            return None
+        parsed.sort(key=lambda p: p[0])
+        new = []
+        with self.lock:
+            for key, ts, text in parsed:
+                if self.since_key is not None and (key < self.since_key or (key == self.since_key and text in self.at_since)):
+                    continue
+                if key != self.since_key:
+                    self.since, self.since_key, self.at_since = ts, key, set()
+                self.at_since.add(text)
+                self.lines.append(text)
+                new.append(text)
+        return new
+
+    def reset(self):
+        with self.lock:
+            self.since = self.since_key = None
+            self.at_since = set()
+            self.lines.clear()
+
+    def tail(self, lines):
+        with self.lock:
+            return "\n".join(list(self.lines)[-lines:])
+
+    def text(self):
+        with self.lock:
+            return "\n".join(self.lines)
+
+    def to_state(self):
+        # Nur die Position, nicht den Puffer: der nächste /logs-Abruf lädt den Tail ohnehin neu (seeded=False)
+        with self.lock:
+            return {"since": self.since, "since_key": self.since_key, "at_since": list(self.at_since)}
+
+    @classmethod
+    def from_state(cls, data):
+        cursor = cls()
+        cursor.since = data["since"]
+        cursor.since_key = tuple(data["since_key"]) if data["since_key"] else None
+        cursor.at_since = set(data["at_since"])
+        return cursor
+
+log_cursors = {}
+log_cursors_lock = threading.Lock()
+
+def get_log_cursor(ip, container):
+    with log_cursors_lock:
+        return log_cursors.setdefault((ip, container), LogCursor())
+
+def forget_log_cursors(ip):
+    with log_cursors_lock:
+        for key in [k for k in log_cursors if k[0] == ip]:
+            del log_cursors[key]
+
+def fetch_new_logs(ip, container, tail=LOG_FETCH_LINES):
+    cursor = get_log_cursor(ip, container)
+    since = f"--since {shlex.quote(cursor.since)} " if cursor.seeded and cursor.since else ""
+    out, _ = ssh_command(ip, f"docker logs --timestamps --tail {tail} {since}{shlex.quote(container)} 2>&1", "logs")
+    if not since:
+        cursor.reset()
+    if cursor.feed(out) is None:
+        raise RuntimeError(out.strip())
+    cursor.seeded = True
+    return cursor
+
+def follow_logs(ip, container, stop, on_lines):
+    # Läuft im SSH-Thread-Pool: ein langlebiger Channel mit "docker logs -f". Mit PTY,
+    # damit der Remote-Prozess beim Schließen des Channels beendet wird.
+    cursor = get_log_cursor(ip, container)
+    since = f"--since {shlex.quote(cursor.since)} " if cursor.since else "--tail 0 "
+    chan = ssh_pool.open_channel(ip)
+    try:
+        chan.get_pty()
+        chan.settimeout(1.0)
+        chan.exec_command(f"docker logs -f --timestamps {since}{shlex.quote(container)} 2>&1")
+        buf = b""
+        while not stop.is_set():
+            try:
+                data = chan.recv(32768)
+            except socket.timeout:
+                continue
+            if not data:
+                break
+            buf += data
+            *complete, buf = buf.split(b"\n")
+            if complete:
+                new = cursor.feed(b"\n".join(complete).decode(errors="replace"))
+                if new:
+                    on_lines(new)
+    finally:
+        ssh_pool.release(ip, chan)
+
+# /logs ... full: ganzes Log gzip-komprimiert als Datei statt der letzten Zeilen als Nachricht.
+# Blockweise vom Channel in eine unbenannte temporäre Datei, damit der Speicher begrenzt bleibt.
+# Keine SpooledTemporaryFile: solange sie im Speicher liegt, ist name None und PTB scheitert daran.
+LOGS_FULL_MAX_BYTES = int(float(os.getenv("LOGS_FULL_MAX_MB", "45")) * 2**20)  # Telegram erlaubt Bots 50 MB
+LOGS_FULL_TIMEOUT = float(os.getenv("LOGS_FULL_TIMEOUT", "120"))
+LOGS_LINE_MAX = 2**20  # längere "Zeilen" (z.B. Fortschrittsbalken mit \r) werden ungeteilt durchgereicht
+LOG_CLEANUP_RE = re.compile(rb"\|[^|\r\n]+?\|")  # wie render_logs, aber nur innerhalb einer Zeile
+
+def stream_logs(ip, container, out, tail=None, since=None, max_bytes=LOGS_FULL_MAX_BYTES, timeout=LOGS_FULL_TIMEOUT):
+    # Gibt (Bytes roh, Zeilen, abgeschnitten) zurück; out enthält danach die gzip-Datei
+    options = f"--since {shlex.quote(since)} " if since else f"--tail {int(tail)} " if tail else ""
+    raw, lines, truncated = 0, 0, False
+    head = b""
+    deadline = time.monotonic() + timeout
+    chan = ssh_pool.open_channel(ip)
+    try:
+        chan.settimeout(1.0)
+        # Auch hier beendet timeout(1) docker logs auf dem Host, falls der Bot vorher abbricht
+        chan.exec_command(f"timeout -k {SSH_KILL_GRACE} {timeout:g} docker logs {options}{shlex.quote(container)} 2>&1")
+        with gzip.GzipFile(fileobj=out, mode="wb") as gz:
+            carry = b""
+            while True:
+                if time.monotonic() > deadline or out.tell() > max_bytes:
+                    truncated = True
+                    break
+                try:
+                    data = chan.recv(65536)
+                except socket.timeout:
+                    continue
+                if not data:
+                    break
+                if raw < 512:
+                    head += data[:512]
+                raw += len(data)
+                block, sep, carry = (carry + data).rpartition(b"\n")
+                if sep:
+                    lines += block.count(b"\n") + 1
+                    gz.write(LOG_CLEANUP_RE.sub(b"", block + sep))
+                elif len(carry) > LOGS_LINE_MAX:
+                    gz.write(carry)
+                    carry = b""
+            if carry and not truncated:
+                lines += 1
+                gz.write(LOG_CLEANUP_RE.sub(b"", carry))
+        # z.B. "No such container": Fehler melden statt als Log-Datei schicken
+        if not truncated and chan.status_event.wait(5) and chan.exit_status not in (0, *TIMEOUT_EXIT_CODES):
+            raise RuntimeError(head.decode(errors="replace").strip() or f"docker logs: Exit {chan.exit_status}")
+    finally:
+        ssh_pool.release(ip, chan)
+    return raw, lines, truncated
+
+
+def escape_html(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("|", "&#124;")
+
+def render_status(name, ip, snap):
+    if snap.container:
+        logs_block = (
+            f"<b>docker logs {snap.container} (letzte {LOG_TAIL_LINES} Zeilen)</b>\n"
+            f"<pre>{escape_html(snap.logs or '')}</pre>"
+        )
+    else:
+        logs_block = "<i>Kein Container gesetzt. Mit /sc &lt;name&gt; setzen.</i>"
+    df_lines = snap.disk_text.splitlines()
+    df_vdb = snap.disk_text if len(df_lines) > 1 else f"{df_lines[0] if df_lines else ''}\n(nicht gefunden)"
+    vdb_warn = ""
+    if snap.disk_percent is not None and snap.disk_percent > DISK_WARN_PERCENT:
+        vdb_warn = f"<b>⚠️ WARNING: {DISK_DEVICE} Belegung über {DISK_WARN_PERCENT}%! Please make space!</b>\n"
+    timeouts = f"<b>⏱ Keine Antwort (Frist überschritten):</b> {', '.join(snap.timed_out)}\n" if snap.timed_out else ""
+    return (
+        f"<b>VServer {name} ({ip}) ist ONLINE</b>\n{timeouts}"
+        f"<b>Uptime:</b> <code>{escape_html(snap.uptime_text)}</code>\n\n"
+        f"<b>docker ps</b>\n<pre>{escape_html(snap.docker_ps)}</pre>\n"
+        f"<b>df -h {DISK_DEVICE}</b>\n<pre>{escape_html(df_vdb)}</pre>\n"
+        f"{vdb_warn}{logs_block}"
+    )
+
+
+# === Ausgehende Telegram-Nachrichten ===
+# Alle automatischen Nachrichten laufen über die Outbox: Token-Bucket pro Chat und global,
+# RetryAfter wird abgewartet, wartende Statusmeldungen werden zusammengefasst und
+# zu lange Nachrichten an Zeilengrenzen geteilt, ohne <pre>-Blöcke kaputtzumachen.
+TELEGRAM_MAX_LENGTH = 4000  # Telegram erlaubt 4096 Zeichen, Reserve für Emoji/Entities
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))  # Nachrichten pro Sekunde und Chat
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))  # Nachrichten pro Sekunde gesamt
+OUTBOX_RETRIES = 3
+
+def _pre_state(in_pre, text):
+    # Ist nach text ein <pre>-Block offen?
+    opened, closed = text.rfind("<pre>"), text.rfind("</pre>")
+    if opened == -1 and closed == -1:
+        return in_pre
+    return opened > closed
+
+def split_message(text, limit=TELEGRAM_MAX_LENGTH):
+    # Teilt an Zeilengrenzen; ein offener <pre>-Block wird am Ende geschlossen und im nächsten Teil neu geöffnet
+    chunks = []
+    current = ""
+    in_pre = False
+    for line in text.split("\n"):
+        while True:
+            sep = "\n" if current and current != "<pre>" else ""
+            after = _pre_state(in_pre, line)
+            if len(current) + len(sep) + len(line) + (6 if after else 0) <= limit:
+                current += sep + line
+                in_pre = after
+                break
+            if current and current != "<pre>":
+                chunks.append(current + ("</pre>" if in_pre else ""))
+                current = "<pre>" if in_pre else ""
+                continue
+            # Einzelne Zeile länger als das Limit: hart teilen, aber möglichst nicht in &...; oder <...>
+            room = limit - len(current) - len(sep) - 6
+            cut = max(line.rfind(" ", 0, room), line.rfind("&", 0, room), line.rfind("<", 0, room))
+            if cut <= 0:
+                cut = room
+            head, line = line[:cut], line[cut:]
+            current += sep + head
+            in_pre = _pre_state(in_pre, head)
+            chunks.append(current + ("</pre>" if in_pre else ""))
+            current = "<pre>" if in_pre else ""
+    if current and current != "<pre>":
+        chunks.append(current + ("</pre>" if in_pre else ""))
+    return chunks
+
+def retry_after_seconds(error):
+    value = error.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+@dataclass
+class OutgoingMessage:
+    text: str
+    parse_mode: str | None = None
+    coalesce: bool = False
+
+class Outbox:
+    def __init__(self, bot, chat_rate=OUTBOX_CHAT_RATE, global_rate=OUTBOX_GLOBAL_RATE):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = {}
+        self._queues = {}
+        self._workers = {}
+        self.throttled = 0
+        self.failed = 0
+
+    @property
+    def depth(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def _bucket(self, chat_id):
+        if chat_id not in self._buckets:
+            self._buckets[chat_id] = TokenBucket(self.chat_rate, 3)
+        return self._buckets[chat_id]
+
+    async def call(self, chat, func, *args, **kwargs):
+        # Einzelner Bot-API-Aufruf unter den Rate-Limits von chat, z.B. edit_message_text
+        bucket = self._bucket(chat)
+        for attempt in range(OUTBOX_RETRIES + 1):
+            await bucket.acquire()
+            await self._global.acquire()
+            try:
+                return await func(*args, **kwargs)
+            except RetryAfter as e:
+                self.throttled += 1
+                wait = retry_after_seconds(e)
+                bucket.block(wait)
+                self._global.block(wait)
+                if attempt == OUTBOX_RETRIES:
+                    raise
+            except (TimedOut, NetworkError):
+                if attempt == OUTBOX_RETRIES:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+
+    def send(self, chat_id, text, parse_mode=None, coalesce=False):
+        # Reiht die Nachricht ein und kehrt sofort zurück; coalesce=True erlaubt das
+        # Zusammenfassen mit anderen wartenden Statusmeldungen für denselben Chat
+        queue = self._queues.setdefault(chat_id, collections.deque())
+        for chunk in split_message(text):
+            queue.append(OutgoingMessage(chunk, parse_mode, coalesce))
+        worker = self._workers.get(chat_id)
+        if worker is None or worker.done():
+            self._workers[chat_id] = asyncio.create_task(self._drain(chat_id))
+
+    def _next(self, queue):
+        msg = queue.popleft()
+        if not msg.coalesce:
+            return msg
+        parts = [msg.text]
+        length = len(msg.text)
+        while queue and queue[0].coalesce and queue[0].parse_mode == msg.parse_mode \
+                and length + 2 + len(queue[0].text) <= TELEGRAM_MAX_LENGTH:
+            nxt = queue.popleft()
+            parts.append(nxt.text)
+            length += 2 + len(nxt.text)
+        return OutgoingMessage("\n\n".join(parts), msg.parse_mode, True)
+
+    async def _drain(self, chat_id):
+        queue = self._queues[chat_id]
+        bucket = self._bucket(chat_id)
+        while queue:
+            # Erst auf das Token warten, dann zusammenfassen: so wird alles gebündelt, was währenddessen ankam
+            await bucket.acquire()
+            bucket.tokens += 1
+            msg = self._next(queue)
+            try:
+                await self.call(chat_id, self.bot.send_message, chat_id=chat_id, text=msg.text, parse_mode=msg.parse_mode)
+            except Exception:
+                self.failed += 1
+                logging.exception("Nachricht an %s konnte nicht gesendet werden", chat_id)
+
+    async def close(self):
+        workers = [w for w in self._workers.values() if not w.done()]
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+outbox = None
+
+async def reply(update, text, parse_mode=None, **kwargs):
+    # Antwort auf ein Kommando, unter denselben Rate-Limits und RetryAfter-Regeln wie die Outbox
+    return await outbox.call(update.effective_chat.id, update.message.reply_text, text, parse_mode=parse_mode, **kwargs)
+
+async def reply_long(update, text, parse_mode=None):
+    # Lange Texte werden wie in der Outbox sicher geteilt
+    for chunk in split_message(text):
+        await reply(update, chunk, parse_mode)
+
+async def error_handler(update, context: ContextTypes.DEFAULT_TYPE):
+    logging.error("Fehler bei der Verarbeitung eines Updates", exc_info=context.error)
 
 
 # === /add <ip> <name> Command ===
 async def add_command(update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or len(context.args) < 2:
-        await update.message.reply_text("Bitte nutze: /add <ip> <name>")
+        await reply(update, "Bitte nutze: /add <ip> <name>")
         return
     ip = context.args[0].strip()
     name = " ".join(context.args[1:]).strip()
     servers = get_all_servers()
     if ip in servers:
-        await update.message.reply_text(f"{ip} existiert bereits. Nutze /sc oder /remove.")
+        await reply(update, f"{ip} existiert bereits. Nutze /sc oder /remove.")
+        return
+    if not valid_server_name(name):
+        await reply(update, f"Ungültiger Name '{name}': keine Leerzeichen, keines von {SELECTOR_CHARS} "
+                            f"und nicht mit {CONTAINER_SELECTOR} beginnend.")
+        return
+    existing = server_registry.find(name)
+    if existing:
+        await reply(update, f"Name '{name}' ist bereits an {existing.ip} vergeben.")
         return
     set_server(ip, {"name": name})
-    # Starte sofort einen eigenen Check-Task für diesen Server
-    global periodic_tasks
-    if 'periodic_tasks' not in globals():
-        periodic_tasks = {}
-    app = context.application
-    periodic_tasks[ip] = asyncio.create_task(periodic_check_server(app, ip))
-    await update.message.reply_text(f"VServer {ip} mit Name '{name}' hinzugefügt und Überwachung gestartet.")
+    # Sofort einplanen, danach im normalen Intervall
+    check_scheduler.add(ip, delay=0)
+    await reply(update, f"VServer {ip} mit Name '{name}' hinzugefügt und Überwachung gestartet.")
 
 # === /remove <ip> Command ===
 async def remove_command(update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or len(context.args) < 1:
-        await update.message.reply_text("Bitte nutze: /remove <name>")
+        await reply(update, "Bitte nutze: /remove <name>")
         return
     name = context.args[0].strip()
-    s = get_settings()
-    servers = s.get("servers", {})
-    ip = next((ip for ip, srv in servers.items() if srv.get('name') == name), None)
+    ip = await find_server_ip(update, name)
     if not ip:
-        await update.message.reply_text(f"Kein VServer mit Name '{name}' gefunden.")
         return
-    del servers[ip]
-    s["servers"] = servers
-    set_settings(s)
-    await update.message.reply_text(f"VServer {name} ({ip}) wurde entfernt.")
+    settings_store.delete_server(ip)
+    check_scheduler.remove(ip)
+    container_watcher.stop(ip)
+    dashboards.mark_dirty()
+    snapshot_cache.pop(ip, None)
+    forget_alerts(ip)
+    forget_log_cursors(ip)
+    last_prune.pop(ip, None)
+    output_cache.pop(ip, None)
+    if check_workers:
+        check_workers.forget(ip)
+    for metric in (ssh_connect_seconds, ssh_connect_failures, ssh_exec_seconds, probe_results, probe_stage_timeouts, prune_deleted_dirs):
+        metric.remove(ip)
+    await asyncio.to_thread(metrics_history.forget, ip)
+    await reply(update, f"VServer {name} ({ip}) wurde entfernt.")
 
 # /sc <name> <container>
 async def sc(update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or len(context.args) < 2:
-        await update.message.reply_text("Bitte nutze: /sc <name> <container>")
+        await reply(update, "Bitte nutze: /sc <name> <container>")
         return
     name = context.args[0].strip()
     container = context.args[1].strip()
-    servers = get_all_servers()
-    ip = next((ip for ip, srv in servers.items() if srv.get('name') == name), None)
+    ip = await find_server_ip(update, name)
     if not ip:
-        await update.message.reply_text(f"Kein VServer mit Name '{name}' gefunden.")
         return
     set_container(ip, container)
-    await update.message.reply_text(f"Container für {name} ({ip}) wurde gesetzt auf {container}")
+    alert_states.pop((ip, "container"), None)
+    alert_states.pop((ip, "health"), None)
+    container_watcher.sync()
+    await reply(update, f"Container für {name} ({ip}) wurde gesetzt auf {container}")
 
 # === /prune Command ===
 async def prune_command(update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or len(context.args) < 1:
-        await update.message.reply_text("Bitte nutze: /prune <name>")
+        await reply(update, "Bitte nutze: /prune <name|@tag|muster> [dry|force]")
         return
-    name = context.args[0].strip()
-    servers = get_all_servers()
-    ip = next((ip for ip, srv in servers.items() if srv.get('name') == name), None)
-    if not ip:
-        await update.message.reply_text(f"Kein VServer mit Name '{name}' gefunden.")
+    dry = len(context.args) > 1 and context.args[1] == "dry"
+    force = len(context.args) > 1 and context.args[1] == "force"
+    records = await resolve_servers(update, context.args[0].strip())
+    if not records:
         return
+
+    async def prune_one(rec):
+        title = f"<b>{escape_html(rec.name)}</b>"
+        if not dry and not force:
+            # Wie beim automatischen Pruning nur bei wenig freiem Platz, sonst nur mit force
+            try:
+                snap = await run_probe(check_probe, rec.ip, None, False)
+            except Exception as e:
+                return f"{title}: Freier Platz nicht ermittelbar: {escape_html(str(e))}"
+            if snap.disk_avail is None or snap.disk_avail >= PRUNE_MIN_FREE_GB * 2**30:
+                free = format_bytes(snap.disk_avail) if snap.disk_avail is not None else "unbekannt"
+                return (f"{title}: {free} frei (Grenze {PRUNE_MIN_FREE_GB:g}G), nichts gelöscht. "
+                        f"Mit /prune {escape_html(rec.name)} force trotzdem löschen")
+        try:
+            keep, delete, freed = await run_prune(rec.ip, dry)
+        except Exception as e:
+            return f"{title}: Fehler beim Pruning: {escape_html(str(e))}"
+        if not dry:
+            last_prune[rec.ip] = time.monotonic()
+        if not delete:
+            return f"{title}: nichts zu löschen ({len(keep)} Verzeichnisse behalten)"
+        if not dry:
+            return f"{title}: {len(delete)} Verzeichnisse gelöscht, {len(keep)} behalten"
+        shown = "\n".join(escape_html(name) for name in delete[:PRUNE_PREVIEW_LINES])
+        more = f"\n… und {len(delete) - PRUNE_PREVIEW_LINES} weitere" if len(delete) > PRUNE_PREVIEW_LINES else ""
+        return (
+            f"{title}: würde {len(delete)} Verzeichnisse löschen und {format_bytes(freed)} freigeben\n"
+            f"Behalten: {escape_html(', '.join(keep)) or '-'}\n<pre>{shown}{more}</pre>"
+        )
+
+    results = await asyncio.gather(*(prune_one(rec) for rec in records))
+    await reply_long(update, "\n\n".join(results), 'HTML')
+
+# /s <name>
+# === Snapshot-Cache ===
+# Letztes Probe-Ergebnis pro Server (aus periodischen Checks und /s). /s antwortet daraus,
+# solange es jünger als SNAPSHOT_TTL ist; "/s <name> !" erzwingt eine Live-Abfrage.
+SNAPSHOT_TTL = float(os.getenv("SNAPSHOT_TTL", "60"))
+snapshot_cache = {}
+
+def cached_snapshot(ip, container):
+    snap = snapshot_cache.get(ip)
+    if snap and snap.container == container and time.time() - snap.taken_at <= SNAPSHOT_TTL:
+        return snap
+    return None
+
+async def server_status(ip, name, force=False):
+    container = get_container(ip)
+    snap = None if force else cached_snapshot(ip, container)
+    if snap:
+        age = time.time() - snap.taken_at
+        return render_status(name, ip, snap) + f"\n<i>Stand: vor {age:.0f} Sekunden (Cache, /s {name} ! für live)</i>"
     try:
-        out, err = prune_output_folders(ip)
-        if err:
-            msg = f"Fehler beim Pruning: {err}"
-        else:
-            msg = "Pruning durchgeführt."
-        await update.message.reply_text(msg)
+        snap = await run_probe(probe_server, ip, container)
+        snapshot_cache[ip] = snap
+        return render_status(name, ip, snap)
     except Exception as e:
-        await update.message.reply_text(f"Fehler beim Pruning: {e}")
+        return f"VServer {name} ({ip}) ist OFFLINE! Fehler: {e}"
+
+FANOUT_DEADLINE = float(os.getenv("FANOUT_DEADLINE", "30"))  # Sekunden für /s über alle Server
+
+async def fleet_status(update, targets, force=False):
+    # Alle Server gleichzeitig prüfen (begrenzt durch SSH_MAX_CONCURRENCY) und jede Antwort
+    # sofort schicken; wer nach FANOUT_DEADLINE noch fehlt, wird als Timeout gemeldet.
+    # Die Frist gilt nur für den Check. Die Antworten laufen mit coalesce durch die Outbox: was
+    # hinter dem Rate-Limit wartet, wird zu gemeinsamen Nachrichten zusammengefasst.
+    chat_id = update.effective_chat.id
+    stragglers = []
+
+    async def one(ip, name):
+        try:
+            msg = await asyncio.wait_for(server_status(ip, name, force), FANOUT_DEADLINE)
+        except asyncio.TimeoutError:
+            stragglers.append(f"{name} ({ip})")
+            return
+        outbox.send(chat_id, msg, 'HTML', coalesce=True)
+
+    tasks = [asyncio.create_task(one(ip, srv.get('name', ip))) for ip, srv in targets]
+    try:
+        await asyncio.gather(*tasks)
+        if stragglers:
+            # Über dieselbe Warteschlange, damit die Meldung nach den Antworten kommt
+            outbox.send(chat_id, f"⏱️ Keine Antwort innerhalb von {FANOUT_DEADLINE:.0f} Sekunden:\n" + "\n".join(stragglers))
+    finally:
+        for task in tasks:
+            task.cancel()
 
-# /s <name>
 async def s_command(update, context: ContextTypes.DEFAULT_TYPE):
     servers = get_all_servers()
-    if not context.args or len(context.args) < 1:
-        if not servers:
-            await update.message.reply_text("Keine VServer eingetragen.")
+    args = [a for a in (context.args or []) if a != "!"]
+    force = len(args) != len(context.args or [])
+    if not servers:
+        await reply(update, "Keine VServer eingetragen.")
+        return
+    if not args:
+        await fleet_status(update, list(servers.items()), force)
+        return
+    selector = args[0].strip()
+    if not any(ch in selector for ch in SELECTOR_CHARS):
+        rec = server_registry.find(selector)
+        if rec:
+            msg = await server_status(rec.ip, rec.name, force)
+            await reply_long(update, msg, 'HTML')
             return
-        for ip, srv in servers.items():
-            name = srv.get('name', ip)
-            try:
-                info = ssh_uptime(ip)
-                docker_ps, _ = ssh_command(ip, 'docker ps')
-                df_h, _ = ssh_command(ip, 'df -h')
-                lines = df_h.splitlines()
-                header = lines[0] if lines else ""
-                vdb = next((line for line in lines if "/dev/vdb" in line), None)
-                df_vdb = f"{header}\n{vdb}" if vdb else f"{header}\n(nicht gefunden)"
-                container = get_container(ip)
-                if container:
-                    logs, _ = ssh_command(ip, f'docker logs --tail 20 {container}')
-                    logs_html = logs.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("|", "&#124;")
-                    logs_block = f"<b>docker logs {container} (letzte 20 Zeilen)</b>\n<pre>{logs_html}</pre>"
-                else:
-                    logs_block = "<i>Kein Container gesetzt. Mit /sc <name> setzen.</i>"
-                vdb_warn = ""
-                if vdb:
-                    try:
-                        parts = vdb.split()
-                        use_str = next((p for p in parts if p.endswith("%")), None)
-                        if use_str and int(use_str.strip("%")) > 80:
-                            vdb_warn = "<b>⚠️ WARNING: /dev/vdb Belegung über 80%! Please make space!</b>\n"
-                    except Exception:
-                        pass
-                msg = (
-                    f"<b>VServer {name} ({ip}) ist ONLINE</b>\n"
-                    f"<b>Uptime:</b> <code>{info}</code>\n\n"
-                    f"<b>docker ps</b>\n<pre>{docker_ps}</pre>\n"
-                    f"<b>df -h /dev/vdb</b>\n<pre>{df_vdb}</pre>\n"
-                    f"{vdb_warn}{logs_block}"
-                )
-            except Exception as e:
-                msg = f"VServer {name} ({ip}) ist OFFLINE! Fehler: {e}"
-            await update.message.reply_text(msg, parse_mode='HTML')
+    records = await resolve_servers(update, selector)
+    if not records:
         return
-    name = context.args[0].strip()
-    ip = next((ip for ip, srv in servers.items() if srv.get('name') == name), None)
-    if not ip:
-        await update.message.reply_text(f"Kein VServer mit Name '{name}' gefunden.")
+    await fleet_status(update, [(rec.ip, servers[rec.ip]) for rec in records if rec.ip in servers], force)
+
+# /group <name> <gruppe>
+async def group_command(update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args or len(context.args) < 2:
+        await reply(update, "Bitte nutze: /group <name|@tag|muster> <gruppe>")
+        return
+    group = context.args[1].strip().lstrip("@")
+    records = await resolve_servers(update, context.args[0].strip())
+    if not records:
+        return
+    for rec in records:
+        set_server_value(rec.ip, "group", group)
+    await reply(update, f"Gruppe für {describe_servers(records)} wurde gesetzt auf {group}")
+
+# /tag <name|@tag|muster> +tag -tag ...
+async def tag_command(update, context: ContextTypes.DEFAULT_TYPE):
+    changes = context.args[1:] if context.args else []
+    if not changes or any(c[:1] not in "+-" or len(c) < 2 for c in changes):
+        await reply(update, "Bitte nutze: /tag <name|@tag|muster> +tag -tag …")
+        return
+    records = await resolve_servers(update, context.args[0].strip())
+    if not records:
         return
+    for rec in records:
+        tags = list(rec.tags)
+        for change in changes:
+            tag = change[1:].lstrip("@")
+            if change[0] == "+" and tag not in tags:
+                tags.append(tag)
+            elif change[0] == "-" and tag in tags:
+                tags.remove(tag)
+        set_server_value(rec.ip, "tags", tags)
+    await reply(update, f"Tags für {describe_servers(records)} geändert: {' '.join(changes)}")
+
+# /logs <name> <container> [follow|stop]
+LOGS_MESSAGE_CHARS = 3500
+LOGS_FOLLOW_TIMEOUT = int(os.getenv("LOGS_FOLLOW_TIMEOUT", "300"))  # Sekunden
+LOGS_FOLLOW_EDIT_INTERVAL = 3  # Sekunden zwischen Aktualisierungen der Nachricht
+log_follows = {}
+
+def render_logs(container, text, title=None):
+    if len(text) > LOGS_MESSAGE_CHARS:
+        text = text[-LOGS_MESSAGE_CHARS:]
+    clean_logs = re.sub(r"\|[^|]+?\|", "", text)
+    return f"{title or f'Logs von {container}:'}\n<pre>{escape_html(clean_logs)}</pre>"
+
+async def follow_command(update, ip, container):
+    key = (update.effective_chat.id, ip, container)
+    if key in log_follows:
+        await reply(update, "Für diesen Container läuft bereits ein follow.")
+        return
+    stop = threading.Event()
+    log_follows[key] = stop
+    shown = collections.deque(maxlen=200)
+    changed = threading.Event()
+
+    def on_lines(lines):
+        shown.extend(lines)
+        changed.set()
+
+    chat_id = update.effective_chat.id
+    message = await reply(update, f"Folge Logs von {container} für {LOGS_FOLLOW_TIMEOUT} Sekunden …")
+    reader = run_in_thread(follow_logs, ip, container, stop, on_lines)
+    deadline = time.monotonic() + LOGS_FOLLOW_TIMEOUT
     try:
-        info = ssh_uptime(ip)
-        docker_ps, _ = ssh_command(ip, 'docker ps')
-        df_h, _ = ssh_command(ip, 'df -h')
-        lines = df_h.splitlines()
-        header = lines[0] if lines else ""
-        vdb = next((line for line in lines if "/dev/vdb" in line), None)
-        df_vdb = f"{header}\n{vdb}" if vdb else f"{header}\n(nicht gefunden)"
-        container = get_container(ip)
-        if container:
-            logs, _ = ssh_command(ip, f'docker logs --tail 20 {container}')
-            logs_html = logs.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("|", "&#124;")
-            logs_block = f"<b>docker logs {container} (letzte 20 Zeilen)</b>\n<pre>{logs_html}</pre>"
-        else:
-            logs_block = "<i>Kein Container gesetzt. Mit /sc <name> setzen.</i>"
-        vdb_warn = ""
-        if vdb:
-            try:
-                parts = vdb.split()
-                use_str = next((p for p in parts if p.endswith("%")), None)
-                if use_str and int(use_str.strip("%")) > 80:
-                    vdb_warn = "<b>⚠️ WARNING: /dev/vdb Belegung über 80%! Please make space!</b>\n"
-            except Exception:
-                pass
-        msg = (
-            f"<b>VServer {name} ({ip}) ist ONLINE</b>\n"
-            f"<b>Uptime:</b> <code>{info}</code>\n\n"
-            f"<b>docker ps</b>\n<pre>{docker_ps}</pre>\n"
-            f"<b>df -h /dev/vdb</b>\n<pre>{df_vdb}</pre>\n"
-            f"{vdb_warn}{logs_block}"
-        )
+        while not stop.is_set() and not reader.done() and time.monotonic() < deadline:
+            await asyncio.sleep(LOGS_FOLLOW_EDIT_INTERVAL)
+            if changed.is_set():
+                changed.clear()
+                left = max(0, deadline - time.monotonic())
+                text = render_logs(container, "\n".join(shown), f"<b>Logs von {container} (live, noch {left:.0f} s)</b>")
+                await outbox.call(chat_id, message.edit_text, text, parse_mode='HTML')
+    finally:
+        stop.set()
+        log_follows.pop(key, None)
+    try:
+        await reader
+        note = "beendet"
     except Exception as e:
-        msg = f"VServer {name} ({ip}) ist OFFLINE! Fehler: {e}"
-    await update.message.reply_text(msg, parse_mode='HTML')
-# /logs <name> <container>
+        note = f"abgebrochen: {e}"
+    text = render_logs(container, "\n".join(shown), f"<b>Logs von {container} (follow {note})</b>")
+    await outbox.call(chat_id, message.edit_text, text, parse_mode='HTML')
+
+async def send_full_logs(update, name, ip, container, limit=None):
+    # limit: Zeilenzahl (--tail) oder alles andere als --since (z.B. 2h, 2026-10-17T08:00)
+    tail = int(limit) if limit and limit.isdigit() else None
+    since = limit if limit and tail is None else None
+    with tempfile.TemporaryFile() as out:
+        raw, lines, truncated = await run_ssh(stream_logs, ip, container, out, tail, since)
+        size = out.tell()
+        caption = f"{container} auf {name}: {lines} Zeilen, {format_bytes(raw)} → {format_bytes(size)} gzip"
+        if truncated:
+            caption += f"\nAbgeschnitten (Limit {format_bytes(LOGS_FULL_MAX_BYTES)} / {LOGS_FULL_TIMEOUT:.0f} s), mit zeilen oder since eingrenzen"
+        filename = f"{name}-{container}-{time.strftime('%Y%m%d-%H%M%S')}.log.gz"
+
+        async def upload():
+            out.seek(0)  # PTB liest die Datei bei jedem Versuch, auch nach RetryAfter, von vorn
+            return await update.message.reply_document(document=out, filename=filename, caption=caption,
+                                                       write_timeout=LOGS_FULL_TIMEOUT)
+
+        await outbox.call(update.effective_chat.id, upload)
+
 async def logs(update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or len(context.args) < 2:
-        await update.message.reply_text("Bitte nutze: /logs <name> <container>")
+        await reply(update, "Bitte nutze: /logs <name> <container> [follow|stop|full [zeilen|since]]")
         return
     name = context.args[0].strip()
     container = context.args[1].strip()
-    servers = get_all_servers()
-    ip = next((ip for ip, srv in servers.items() if srv.get('name') == name), None)
+    mode = context.args[2].strip() if len(context.args) > 2 else None
+    ip = await find_server_ip(update, name)
     if not ip:
-        await update.message.reply_text(f"Kein VServer mit Name '{name}' gefunden.")
         return
-    try:
-        logs, error = ssh_command(ip, f'docker logs --tail 2000 {container}')
-        if error:
-            msg = f"Fehler beim Abrufen der Logs: {error}"
+    if mode == "stop":
+        stop = log_follows.get((update.effective_chat.id, ip, container))
+        if stop:
+            stop.set()
         else:
-            if len(logs) > 3500:
-                logs = logs[-3500:]
-            clean_logs = re.sub(r"\|[^|]+?\|", "", logs)
-            logs_html = clean_logs.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("|", "&#124;")
-            msg = f"Logs von {container}:\n<pre>{logs_html}</pre>"
-        await update.message.reply_text(msg, parse_mode='HTML')
+            await reply(update, "Kein laufendes follow für diesen Container.")
+        return
+    try:
+        if mode == "follow":
+            await follow_command(update, ip, container)
+            return
+        if mode == "full":
+            await send_full_logs(update, name, ip, container, context.args[3].strip() if len(context.args) > 3 else None)
+            return
+        # Nur Zeilen seit dem letzten Abruf kommen über SSH, der Rest liegt im Cursor-Puffer
+        cursor = await run_ssh(fetch_new_logs, ip, container)
+        await reply_long(update, render_logs(container, cursor.text()), 'HTML')
     except Exception as e:
-        await update.message.reply_text(f"Fehler: {e}")
+        await reply(update, f"Fehler: {e}")
 
 # === /output Command ===
-# /output <name>
+# Strukturierte Liste von PRUNE_DIR (Name, Typ, Größe, mtime; mit "du" auch rekursive
+# Verzeichnisgrößen) in einem Roundtrip, pro Host OUTPUT_CACHE_TTL Sekunden gecacht.
+# Blättern und Sortieren per Inline-Keyboard arbeitet nur auf dem Cache.
+OUTPUT_CACHE_TTL = float(os.getenv("OUTPUT_CACHE_TTL", "300"))
+OUTPUT_TIMEOUT = float(os.getenv("OUTPUT_TIMEOUT", "120"))  # Frist für find/du
+OUTPUT_PAGE_SIZE = 25
+OUTPUT_NAME_WIDTH = 60
+# "/" kann in keinem Dateinamen vorkommen, taugt also als Trenner zwischen find- und du-Teil
+OUTPUT_LIST = "cd {dir} || exit 1\nfind . -mindepth 1 -maxdepth 1 -printf '%y\\t%s\\t%T@\\t%f\\0'\n"
+OUTPUT_DU = "printf '/du/\\0'\ndu -0 -b -d1 . 2>/dev/null\n"
+OUTPUT_SORTS = {
+    "size": ("Größe", lambda e: e.size, True),
+    "mtime": ("Datum", lambda e: e.mtime, True),
+    "name": ("Name", lambda e: e.name.lower(), False),
+}
+
+@dataclass
+class OutputEntry:
+    name: str
+    kind: str  # d, f, l, ... wie find %y
+    size: int
+    mtime: float
+
+@dataclass
+class OutputListing:
+    ip: str
+    taken_at: float
+    entries: list
+    with_du: bool
+
+output_cache = {}
+
+def parse_output_listing(ip, raw, with_du):
+    records = raw.split("\0")
+    marker = records.index("/du/") if "/du/" in records else len(records)
+    entries = {}
+    for record in records[:marker]:
+        parts = record.lstrip("\n").split("\t", 3)
+        if len(parts) == 4:
+            kind, size, mtime, name = parts
+            entries[name] = OutputEntry(name, kind, int(size), float(mtime))
+    for record in records[marker + 1:]:
+        size, _, path = record.lstrip("\n").partition("\t")
+        entry = entries.get(path[2:]) if path.startswith("./") else None
+        if entry and size.isdigit():
+            entry.size = int(size)
+    return OutputListing(ip, time.time(), list(entries.values()), with_du)
+
+def fetch_output_listing(ip, with_du):
+    script = OUTPUT_LIST.format(dir=shlex.quote(PRUNE_DIR)) + (OUTPUT_DU if with_du else "")
+    out, err = ssh_command(ip, script, "output", OUTPUT_TIMEOUT)
+    if err and not out:
+        raise RuntimeError(err)
+    return parse_output_listing(ip, out, with_du)
+
+async def get_output_listing(ip, with_du=False, refresh=False):
+    listing = output_cache.get(ip)
+    fresh = listing and time.time() - listing.taken_at <= OUTPUT_CACHE_TTL
+    # Eine Liste mit du-Größen reicht auch für Anfragen ohne du
+    if refresh or not fresh or (with_du and not listing.with_du):
+        listing = await run_ssh(fetch_output_listing, ip, with_du or bool(refresh and listing and listing.with_du))
+        output_cache[ip] = listing
+    return listing
+
+def render_output_page(name, listing, sort, page):
+    label, key, reverse = OUTPUT_SORTS[sort]
+    entries = sorted(listing.entries, key=key, reverse=reverse)
+    pages = max(1, -(-len(entries) // OUTPUT_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    rows = []
+    for e in entries[page * OUTPUT_PAGE_SIZE:(page + 1) * OUTPUT_PAGE_SIZE]:
+        shown = e.name if len(e.name) <= OUTPUT_NAME_WIDTH else e.name[:OUTPUT_NAME_WIDTH - 1] + "…"
+        stamp = time.strftime("%Y-%m-%d %H:%M", time.localtime(e.mtime))
+        rows.append(f"{format_bytes(e.size):>10}  {stamp}  {escape_html(shown)}{'/' if e.kind == 'd' else ''}")
+    summary = f"{len(entries)} Einträge"
+    if listing.with_du:
+        summary += f", {format_bytes(sum(e.size for e in entries))} gesamt"
+    text = (
+        f"<b>{escape_html(PRUNE_DIR)} auf {escape_html(name)}</b>\n"
+        f"{summary} · sortiert nach {label} · Seite {page + 1}/{pages}\n"
+        f"<pre>{chr(10).join(rows) or '(leer)'}</pre>\n"
+        f"<i>Stand: vor {time.time() - listing.taken_at:.0f} Sekunden"
+        f"{'' if listing.with_du else ', Verzeichnisgrößen mit /output ' + escape_html(name) + ' du'}</i>"
+    )
+    data = f"out|{listing.ip}|{sort}|"
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("‹ zurück", callback_data=f"{data}{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("weiter ›", callback_data=f"{data}{page + 1}"))
+    sorts = [
+        InlineKeyboardButton(("✓ " if key == sort else "") + title, callback_data=f"out|{listing.ip}|{key}|0")
+        for key, (title, _, _) in OUTPUT_SORTS.items()
+    ]
+    refresh = [InlineKeyboardButton("⟳ neu laden", callback_data=f"{data}{page}|r")]
+    return text, InlineKeyboardMarkup([row for row in (nav, sorts, refresh) if row])
+
+# /output <name> [size|mtime|name] [du]
 async def output_command(update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or len(context.args) < 1:
-        await update.message.reply_text("Bitte nutze: /output <name>")
+        await reply(update, "Bitte nutze: /output <name> [size|mtime|name] [du]")
         return
     name = context.args[0].strip()
-    servers = get_all_servers()
-    ip = next((ip for ip, srv in servers.items() if srv.get('name') == name), None)
+    ip = await find_server_ip(update, name)
     if not ip:
-        await update.message.reply_text(f"Kein VServer mit Name '{name}' gefunden.")
         return
+    options = context.args[1:]
+    with_du = "du" in options
+    sort = next((o for o in options if o in OUTPUT_SORTS), "size" if with_du else "mtime")
     try:
-        out, err = ssh_command(ip, 'ls -lh /mnt/output')
-        if err:
-            msg = f"Fehler beim Ausführen von ls: {err}"
-        else:
-            clean_out = re.sub(r"\|[^|]+?\|", "", out)
-            out_html = clean_out.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("|", "&#124;")
-            msg = f"<b>ls -lh /mnt/output</b>\n<pre>{out_html}</pre>"
-        await update.message.reply_text(msg, parse_mode='HTML')
+        listing = await get_output_listing(ip, with_du)
+    except Exception as e:
+        await reply(update, f"Fehler: {e}")
+        return
+    text, markup = render_output_page(name, listing, sort, 0)
+    await reply(update, text, parse_mode='HTML', reply_markup=markup)
+
+async def output_callback(update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    _, ip, sort, page, *flags = query.data.split("|")
+    rec = server_registry.get(ip)
+    if rec is None or sort not in OUTPUT_SORTS:
+        await query.answer("Server nicht mehr eingetragen.")
+        return
+    try:
+        listing = await get_output_listing(ip, refresh="r" in flags)
     except Exception as e:
-        await update.message.reply_text(f"Fehler: {e}")
+        await query.answer(f"Fehler: {e}"[:200], show_alert=True)
+        return
+    await query.answer()
+    text, markup = render_output_page(rec.name, listing, sort, int(page))
+    try:
+        await outbox.call(update.effective_chat.id, query.edit_message_text, text, parse_mode='HTML', reply_markup=markup)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
 
 # === /list Command ===
 async def list_command(update, context: ContextTypes.DEFAULT_TYPE):
     servers = get_all_servers()
     if not servers:
-        await update.message.reply_text("Keine VServer eingetragen.")
+        await reply(update, "Keine VServer eingetragen.")
         return
     msg = "<b>Alle VServer:</b>\n" + "\n".join([
-        f"{srv.get('name','-')} ({ip}) - Container: {srv.get('container','-')}" for ip, srv in servers.items()
+        f"{srv.get('name','-')} ({ip}) - Container: {srv.get('container','-')} - Gruppe: {srv.get('group','-')}"
+        + (f" - Tags: {' '.join(srv['tags'])}" if srv.get('tags') else "")
+        for ip, srv in servers.items()
     ])
-    await update.message.reply_text(msg, parse_mode='HTML')
+    await reply_long(update, msg, 'HTML')
 
 # === /settings Command ===
 # /settings <name>
@@ -355,7 +1711,7 @@ async def settings_command(update, context: ContextTypes.DEFAULT_TYPE):
     servers = get_all_servers()
     if not context.args or len(context.args) < 1:
         if not servers:
-            await update.message.reply_text("Keine VServer eingetragen.")
+            await reply(update, "Keine VServer eingetragen.")
             return
         msg = "<b>Alle Einstellungen:</b>\n"
         for ip, srv in servers.items():
@@ -369,27 +1725,26 @@ async def settings_command(update, context: ContextTypes.DEFAULT_TYPE):
                 f"Intervall: {interval} Sekunden\n"
                 f"Periodische Statusmeldungen: {'aktiv' if periodic else 'pausiert'}\n"
             )
-        await update.message.reply_text(msg, parse_mode='HTML')
+        await reply_long(update, msg, 'HTML')
         return
-    name = context.args[0].strip()
-    ip = next((ip for ip, srv in servers.items() if srv.get('name') == name), None)
-    if not ip:
-        await update.message.reply_text(f"Kein VServer mit Name '{name}' gefunden.")
+    records = await resolve_servers(update, context.args[0].strip())
+    if not records:
         return
-    container = get_container(ip)
-    interval = get_server_value(ip, "interval", 60)
-    periodic = get_server_value(ip, "periodic_running", True)
-    msg = (
-        f"<b>Einstellungen für {name}:</b>\n"
-        f"<b>IP:</b> {ip}\n"
-        f"<b>Container:</b> {container if container else 'Nicht gesetzt'}\n"
-        f"<b>Intervall:</b> {interval} Sekunden\n"
-        f"<b>Periodische Statusmeldungen:</b> {'aktiv' if periodic else 'pausiert'}\n"
-    )
-    await update.message.reply_text(msg, parse_mode='HTML')
+    msg = ""
+    for rec in records:
+        interval = get_server_value(rec.ip, "interval", 60)
+        periodic = get_server_value(rec.ip, "periodic_running", True)
+        msg += (
+            f"<b>Einstellungen für {rec.name}:</b>\n"
+            f"<b>IP:</b> {rec.ip}\n"
+            f"<b>Container:</b> {rec.container if rec.container else 'Nicht gesetzt'}\n"
+            f"<b>Gruppe/Tags:</b> {' '.join(rec.labels) or '-'}\n"
+            f"<b>Intervall:</b> {interval} Sekunden (aktuell {effective_interval(rec.ip):.0f})\n"
+            f"<b>Periodische Statusmeldungen:</b> {'aktiv' if periodic else 'pausiert'}\n\n"
+        )
+    await reply_long(update, msg.rstrip(), 'HTML')
 
 # === Periodische Checks pro Server ===
-periodic_tasks = {}
 
 def get_periodic_running(ip=None):
     if ip:
@@ -397,9 +1752,7 @@ def get_periodic_running(ip=None):
     return get_settings().get("periodic_running", True)
 
 def set_periodic_running(value: bool):
-    s = get_settings()
-    s["periodic_running"] = value
-    set_settings(s)
+    settings_store.set_value("periodic_running", value)
 
 def get_server_interval(ip):
     # Hole Intervall für Server, fallback auf global
@@ -408,143 +1761,1359 @@ def get_server_interval(ip):
 def set_server_interval(ip, value):
     set_server_value(ip, "interval", value)
 
+# === Alarm-Zustände ===
+# Pro Server und Check (offline, container) ein Zustandsautomat OK → SUSPECT → DOWN → RECOVERED.
+# Alarm erst nach ALERT_FAILURES Fehlern in Folge, danach Erinnerungen mit wachsendem Abstand.
+ALERT_FAILURES = int(os.getenv("ALERT_FAILURES", "3"))
+ALERT_RECOVERIES = int(os.getenv("ALERT_RECOVERIES", "1"))  # Erfolge in Folge bis zur Entwarnung
+ALERT_REMINDERS = [int(x) for x in os.getenv("ALERT_REMINDERS", "300,900,3600,10800").split(",")]  # Sekunden
+
+ALERT_OK = "OK"
+ALERT_SUSPECT = "SUSPECT"
+ALERT_DOWN = "DOWN"
+ALERT_RECOVERED = "RECOVERED"
+
+class AlertState:
+    __slots__ = ("state", "failures", "successes", "since", "notified_at", "reminders")
+
+    def __init__(self):
+        self.state = ALERT_OK
+        self.failures = 0
+        self.successes = 0
+        self.since = None
+        self.notified_at = None
+        self.reminders = 0
+
+    def update(self, failed, now):
+        # Liefert "alert", "remind", "recovered" oder None
+        if failed:
+            self.failures += 1
+            self.successes = 0
+            if self.state in (ALERT_OK, ALERT_RECOVERED):
+                self.state = ALERT_SUSPECT
+                self.since = now
+            if self.state == ALERT_SUSPECT and self.failures >= ALERT_FAILURES:
+                self.state = ALERT_DOWN
+                self.notified_at = now
+                self.reminders = 0
+                return "alert"
+            if self.state == ALERT_DOWN:
+                delay = ALERT_REMINDERS[min(self.reminders, len(ALERT_REMINDERS) - 1)]
+                if now - self.notified_at >= delay:
+                    self.notified_at = now
+                    self.reminders += 1
+                    return "remind"
+            return None
+        self.failures = 0
+        self.successes += 1
+        if self.state == ALERT_DOWN:
+            if self.successes >= ALERT_RECOVERIES:
+                self.state = ALERT_RECOVERED
+                return "recovered"
+        elif self.state != ALERT_OK:
+            self.state = ALERT_OK
+        return None
+
+    def force(self, failed, now):
+        # Für Ereignisse statt Messungen: sofort DOWN bzw. OK, ohne ALERT_FAILURES abzuwarten
+        if failed:
+            if self.state == ALERT_DOWN:
+                return None
+            self.state = ALERT_DOWN
+            self.failures = max(self.failures, ALERT_FAILURES)
+            self.successes = 0
+            self.since = self.notified_at = now
+            self.reminders = 0
+            return "alert"
+        self.failures = 0
+        self.successes = ALERT_RECOVERIES
+        if self.state == ALERT_DOWN:
+            self.state = ALERT_RECOVERED
+            return "recovered"
+        self.state = ALERT_OK
+        return None
+
+alert_states = {}
+
+def update_alert(ip, check, failed, now=None):
+    state = alert_states.setdefault((ip, check), AlertState())
+    return state.update(failed, now or time.time()), state
+
+def force_alert(ip, check, failed, now=None):
+    state = alert_states.setdefault((ip, check), AlertState())
+    return state.force(failed, now or time.time()), state
+
+def forget_alerts(ip):
+    for key in [k for k in alert_states if k[0] == ip]:
+        del alert_states[key]
+
+def format_duration(seconds):
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{minutes} min"
+    if minutes < 24 * 60:
+        return f"{minutes // 60} h {minutes % 60} min"
+    return f"{minutes // 1440} d {minutes % 1440 // 60} h"
+
+def container_alert_message(action, state, name, ip, container):
+    if action == "unhealthy":
+        return f"<b>⚠️ Container <code>{container}</code> auf {name} ({ip}) ist UNHEALTHY!</b>"
+    if action == "healthy":
+        return f"<b>✅ Container <code>{container}</code> auf {name} ({ip}) ist wieder healthy</b>"
+    if action == "alert":
+        return (
+            f"<b>🚨 Container DOWN!</b>\n"
+            f"<b>Container <code>{container}</code> läuft NICHT auf {name} ({ip})!</b>\n"
+            f"Bitte prüfen!"
+        )
+    if action == "remind":
+        return (
+            f"<b>🔁 Container <code>{container}</code> auf {name} ({ip}) läuft weiterhin NICHT</b> "
+            f"(seit {format_duration(time.time() - state.since)})"
+        )
+    return (
+        f"<b>✅ Container <code>{container}</code> auf {name} ({ip}) läuft wieder</b> "
+        f"(Ausfall: {format_duration(time.time() - state.since)})"
+    )
+
+def offline_alert_message(action, state, name, ip, error):
+    if action == "alert":
+        return (
+            "<b>🚨🚨🚨 SERVER OFFLINE! 🚨🚨🚨</b>\n"
+            f"<b>VServer {name} ({ip}) ist OFFLINE!</b>\n"
+            f"<b>Fehler:</b> <code>{escape_html(str(error))}</code>\n"
+            "<b>BITTE SOFORT PRÜFEN!</b>"
+        )
+    if action == "remind":
+        return (
+            f"<b>🔁 VServer {name} ({ip}) ist weiterhin OFFLINE</b> "
+            f"(seit {format_duration(time.time() - state.since)})\n"
+            f"<b>Fehler:</b> <code>{escape_html(str(error))}</code>"
+        )
+    return (
+        f"<b>✅ VServer {name} ({ip}) ist wieder ONLINE</b> "
+        f"(Ausfall: {format_duration(time.time() - state.since)})"
+    )
+
 async def periodic_check_server(app, ip):
-    while True:
-        interval = get_server_interval(ip)
+    # Ein Check-Durchlauf; wann er läuft, entscheidet der CheckScheduler
+    container = get_container(ip)
+    # Mit aktivem docker-events-Watch kennt der Bot den Container-Zustand schon
+    watched = container_watcher.state(ip, container) if container else None
+    try:
+        # Ein Roundtrip: Status, Platz und Logs in einem Skript
+        snap = await run_probe(check_probe, ip, container, watched is None)
+    except Exception as e:
+        probe_results.inc(ip, "unreachable" if isinstance(e, HostUnreachable) else "error")
+        metrics_history.record(ip, {"online": 0})
+        name = get_server_value(ip, 'name', ip)
+        action, state = update_alert(ip, "offline", True)
+        if action:
+            outbox.send(TELEGRAM_CHAT_ID, offline_alert_message(action, state, name, ip, e), 'HTML')
+        return
+    # Ohne Antwort von docker ps -a ist über den Container nichts bekannt
+    container_known = watched is not None or "containers" not in snap.timed_out
+    if watched is not None:
+        snap.containers[container] = "running" if watched else "exited"
+    elif container_known and container_watcher.is_watching(ip, container):
+        container_watcher.running[ip] = snap.container_running(container)
+    probe_results.inc(ip, "partial" if snap.timed_out else "ok")
+    for stage in snap.timed_out:
+        probe_stage_timeouts.inc(ip, stage)
+    previous = snapshot_cache.get(ip)
+    snapshot_cache[ip] = snap
+    metrics_history.record_snapshot(snap)
+    name = get_server_value(ip, 'name', ip)
+    action, state = update_alert(ip, "offline", False)
+    if action:
+        outbox.send(TELEGRAM_CHAT_ID, offline_alert_message(action, state, name, ip, None), 'HTML')
+    if container and container_known:
+        action, state = update_alert(ip, "container", not snap.container_running(container))
+        if action:
+            outbox.send(TELEGRAM_CHAT_ID, container_alert_message(action, state, name, ip, container), 'HTML')
+    if dashboards.covers(TELEGRAM_CHAT_ID, ip):
+        # Dashboard statt Vollstatus: nur echte Änderungen als neue Nachricht
+        changes = detect_changes(previous, snap)
+        if changes and get_periodic_running(ip):
+            outbox.send(TELEGRAM_CHAT_ID, f"<b>ℹ️ {name} ({ip})</b>\n" + "\n".join(changes), 'HTML', coalesce=True)
+    elif get_periodic_running(ip):
+        outbox.send(TELEGRAM_CHAT_ID, render_status(name, ip, snap), 'HTML', coalesce=True)
+    dashboards.mark_dirty()
+    if needs_prune(ip, snap):
+        # Im Hintergrund auf dem prune_executor, damit ein langes rm -rf weder den Check noch SSH-Threads blockiert
+        task = asyncio.create_task(auto_prune(ip, name))
+        prune_tasks.add(task)
+        task.add_done_callback(prune_tasks.discard)
+
+
+# === Dashboard ===
+# Pro Chat (und optional pro Gruppe) eine angepinnte Übersichtsnachricht, die per
+# edit_message_text nur aktualisiert wird, wenn sich der gerenderte Inhalt ändert.
+DASHBOARD_MIN_EDIT = float(os.getenv("DASHBOARD_MIN_EDIT", "15"))  # Sekunden zwischen Aktualisierungen
+DASHBOARD_ORDER = "🔴🟡⚪🟢"  # was nicht in eine Nachricht passt, wird von hinten weggelassen
+# Nur grobe Werte, damit sich der Text (und damit der Hash) nur bei echten Zustandsänderungen ändert
+DASHBOARD_LOAD_BANDS = (1, 4, 16)
+
+def load_band(load):
+    for limit in DASHBOARD_LOAD_BANDS:
+        if load < limit:
+            return f"load &lt;{limit}"
+    return f"load ≥{DASHBOARD_LOAD_BANDS[-1]}"
+
+def uptime_days(seconds):
+    days = int(seconds // 86400)
+    return f"up {days}d" if days else "up &lt;1d"
+
+def detect_changes(previous, snap):
+    if previous is None:
+        return []
+    changes = []
+    if previous.containers_listed and snap.containers_listed:
+        before = {n for n, st in previous.containers.items() if st == "running"}
+        after = {n for n, st in snap.containers.items() if st == "running"}
+        if after - before:
+            changes.append("Gestartet: " + ", ".join(f"<code>{escape_html(n)}</code>" for n in sorted(after - before)))
+        if before - after:
+            changes.append("Gestoppt: " + ", ".join(f"<code>{escape_html(n)}</code>" for n in sorted(before - after)))
+    if previous.disk_percent is not None and snap.disk_percent is not None:
+        was_high = previous.disk_percent > DISK_WARN_PERCENT
+        is_high = snap.disk_percent > DISK_WARN_PERCENT
+        if is_high != was_high:
+            direction = "über" if is_high else "unter"
+            changes.append(f"{DISK_DEVICE} jetzt {direction} {DISK_WARN_PERCENT}% ({snap.disk_percent}%)")
+    if snap.uptime_seconds < previous.uptime_seconds:
+        changes.append(f"Neustart erkannt (Uptime {format_duration(snap.uptime_seconds)})")
+    return changes
+
+def render_dashboard(group):
+    lines = [f"<b>📊 Dashboard{f' @{group}' if group else ''}</b>"]
+    for ip, srv in sorted(get_all_servers().items(), key=lambda item: item[1].get('name', item[0])):
+        if group and group not in server_registry.get(ip).labels:
+            continue
+        name = escape_html(srv.get('name', ip))
+        offline = alert_states.get((ip, "offline"))
+        snap = snapshot_cache.get(ip)
+        if offline and offline.state == ALERT_DOWN:
+            lines.append(f"🔴 <b>{name}</b> offline seit {time.strftime('%d.%m. %H:%M', time.localtime(offline.since))}")
+            continue
+        if snap is None:
+            lines.append(f"⚪ <b>{name}</b> noch keine Daten")
+            continue
+        container = srv.get('container')
+        warn = any(
+            a.state != ALERT_OK for key, a in alert_states.items() if key[0] == ip
+        ) or (snap.disk_percent or 0) > DISK_WARN_PERCENT or bool(snap.timed_out)
+        parts = [load_band(snap.load[0])]
+        if snap.disk_percent is not None:
+            parts.append(f"disk {snap.disk_percent}%")
+        if container:
+            parts.append(f"{escape_html(container)} {'läuft' if snap.container_running(container) else 'DOWN'}")
+        parts.append(uptime_days(snap.uptime_seconds))
+        if snap.timed_out:
+            parts.append("⏱ " + ", ".join(snap.timed_out))
+        lines.append(f"{'🟡' if warn else '🟢'} <b>{name}</b> " + " · ".join(parts))
+    text = "\n".join(lines)
+    if len(text) <= TELEGRAM_MAX_LENGTH:
+        return text
+    # Zu lang für eine Nachricht: auffällige Server zuerst, der Rest wird nur gezählt
+    header, entries = lines[0], sorted(lines[1:], key=lambda line: DASHBOARD_ORDER.index(line[0]))
+    shown, length = [], len(header) + 200  # Reserve für die Schlusszeile
+    for line in entries:
+        if length + len(line) + 1 > TELEGRAM_MAX_LENGTH:
+            break
+        shown.append(line)
+        length += len(line) + 1
+    rest = entries[len(shown):]
+    healthy = sum(1 for line in rest if line[0] == "🟢")
+    footer = (f"<i>… {len(rest)} weitere Server ({healthy} ohne Befund) passen nicht in die Nachricht. "
+              f"Mit /tag und /dashboard on @gruppe aufteilen.</i>")
+    return "\n".join([header, *shown, footer])
+
+class Dashboards:
+    def __init__(self):
+        self._hashes = {}
+        self._dirty = None
+        self._task = None
+
+    def _config(self):
+        # {chat_id: {gruppe: message_id}}, "" = alle Server
+        return get_settings().get("dashboards", {})
+
+    def _save(self, config):
+        settings_store.set_value("dashboards", config)
+
+    def covers(self, chat_id, ip):
+        groups = self._config().get(str(chat_id), {})
+        rec = server_registry.get(ip)
+        return "" in groups or bool(rec and any(label in groups for label in rec.labels))
+
+    def mark_dirty(self):
+        if self._dirty is not None:
+            self._dirty.set()
+
+    def start(self):
+        self._dirty = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    async def _run(self):
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            try:
+                await self.refresh()
+            except Exception:
+                logging.exception("Dashboard-Aktualisierung fehlgeschlagen")
+            await asyncio.sleep(DASHBOARD_MIN_EDIT)
+
+    async def refresh(self):
+        for chat, groups in list(self._config().items()):
+            for group, message_id in list(groups.items()):
+                await self._update(chat, group, message_id)
+
+    async def _update(self, chat, group, message_id):
+        text = render_dashboard(group)
+        digest = hashlib.sha1(text.encode()).hexdigest()
+        if self._hashes.get((chat, group)) == digest:
+            return
+        try:
+            await outbox.call(int(chat), outbox.bot.edit_message_text, text, chat_id=int(chat),
+                              message_id=message_id, parse_mode='HTML')
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                # Nachricht gelöscht o.ä.: neu anlegen
+                await self.create(int(chat), group)
+                return
+        self._hashes[(chat, group)] = digest
+
+    async def enable(self, chat_id, group):
+        # Ein bestehendes Dashboard wird weiterverwendet statt ein zweites anzupinnen
+        message_id = self._config().get(str(chat_id), {}).get(group)
+        if message_id is None:
+            await self.create(chat_id, group)
+            return
+        self._hashes.pop((str(chat_id), group), None)
+        await self._update(str(chat_id), group, message_id)
+
+    async def create(self, chat_id, group):
+        text = render_dashboard(group)
+        message = await outbox.call(chat_id, outbox.bot.send_message, chat_id=chat_id, text=text, parse_mode='HTML')
+        try:
+            await outbox.call(chat_id, outbox.bot.pin_chat_message, chat_id=chat_id,
+                              message_id=message.message_id, disable_notification=True)
+        except TelegramError as e:
+            logging.info("Dashboard konnte nicht angepinnt werden: %s", e)
+        config = self._config()
+        config.setdefault(str(chat_id), {})[group] = message.message_id
+        self._save(config)
+        self._hashes[(str(chat_id), group)] = hashlib.sha1(text.encode()).hexdigest()
+
+    async def remove(self, chat_id, group):
+        config = self._config()
+        message_id = config.get(str(chat_id), {}).pop(group, None)
+        if message_id is None:
+            return False
+        if not config[str(chat_id)]:
+            del config[str(chat_id)]
+        self._save(config)
+        self._hashes.pop((str(chat_id), group), None)
         try:
-            info = ssh_uptime(ip)
-            docker_ps, _ = ssh_command(ip, 'docker ps')
-            df_h, _ = ssh_command(ip, 'df -h')
-            lines = df_h.splitlines()
-            header = lines[0] if lines else ""
-            vdb = next((line for line in lines if "/dev/vdb" in line), None)
-            df_vdb = f"{header}\n{vdb}" if vdb else f"{header}\n(nicht gefunden)"
+            await outbox.call(chat_id, outbox.bot.unpin_chat_message, chat_id=chat_id, message_id=message_id)
+        except TelegramError:
+            pass
+        return True
+
+dashboards = Dashboards()
+
+# /dashboard on|off [@gruppe]
+async def dashboard_command(update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args or context.args[0] not in ("on", "off"):
+        await reply(update, "Bitte nutze: /dashboard on|off [@gruppe]")
+        return
+    group = context.args[1].lstrip("@") if len(context.args) > 1 else ""
+    chat_id = update.effective_chat.id
+    if context.args[0] == "on":
+        await dashboards.enable(chat_id, group)
+        return
+    if await dashboards.remove(chat_id, group):
+        await reply(update, "Dashboard deaktiviert, periodische Statusmeldungen wieder vollständig.")
+    else:
+        await reply(update, "Kein Dashboard für diesen Chat aktiv.")
+
+
+# === Adaptive Intervalle ===
+# Basis ist das per /interval gesetzte Intervall. Gesunde Server werden schrittweise seltener
+# geprüft, auffällige oder gerade erholte häufiger, dauerhaft offline mit exponentiellem Backoff.
+ADAPTIVE_INTERVALS = os.getenv("ADAPTIVE_INTERVALS", "1") == "1"
+ADAPTIVE_MIN_INTERVAL = 10
+ADAPTIVE_MAX_STRETCH = float(os.getenv("ADAPTIVE_MAX_STRETCH", "3"))  # max. Faktor für gesunde Server
+ADAPTIVE_STRETCH_AFTER = 10  # gesunde Checks in Folge pro +50%
+ADAPTIVE_OFFLINE_MAX = int(os.getenv("ADAPTIVE_OFFLINE_MAX", "900"))  # Sekunden
+
+def effective_interval(ip):
+    base = get_server_interval(ip)
+    if not ADAPTIVE_INTERVALS:
+        return base
+    offline = alert_states.get((ip, "offline"))
+    if offline and offline.state == ALERT_DOWN and not offline.successes:
+        extra = max(0, offline.failures - ALERT_FAILURES)
+        return max(ADAPTIVE_MIN_INTERVAL, min(base * 2 ** min(extra, 10), max(base, ADAPTIVE_OFFLINE_MAX)))
+    # DOWN mit ersten Erfolgen (ALERT_RECOVERIES > 1) zählt als Erholung und landet unten bei base / 2
+    states = [alert_states.get((ip, check)) for check in ("offline", "container", "health")]
+    if any(a.state != ALERT_OK for a in states if a):
+        return max(ADAPTIVE_MIN_INTERVAL, base / 2)
+    streak = offline.successes if offline else 0
+    return base * min(ADAPTIVE_MAX_STRETCH, 1 + 0.5 * (streak // ADAPTIVE_STRETCH_AFTER))
+
+
+# === Docker-Events-Watch ===
+# Optional hält der Bot pro Server einen langlebigen Channel mit "docker events" offen und
+# meldet die/stop/start/health_status sofort. Solange der Watch verbunden ist, spart der
+# periodische Check das "docker ps -a"; bricht er ab, wird neu verbunden und bis dahin gepollt.
+DOCKER_EVENTS_WATCH = os.getenv("DOCKER_EVENTS_WATCH", "0") == "1"  # für alle Server, sonst per /watch
+WATCH_EVENTS = ("die", "stop", "start", "health_status")
+WATCH_BACKOFF_MAX = 60
+
+def watch_docker_events(ip, container, stop, on_event):
+    chan = ssh_pool.open_channel(ip)
+    try:
+        chan.get_pty()
+        chan.settimeout(1.0)
+        filters = " ".join(f"--filter event={e}" for e in WATCH_EVENTS)
+        chan.exec_command(
+            f"docker events --filter container={shlex.quote(container)} {filters} --format '{{{{json .}}}}'"
+        )
+        on_event(None)
+        buf = b""
+        while not stop.is_set():
+            try:
+                data = chan.recv(8192)
+            except socket.timeout:
+                continue
+            if not data:
+                break
+            buf += data
+            *complete, buf = buf.split(b"\n")
+            for line in complete:
+                try:
+                    on_event(json.loads(line))
+                except ValueError:
+                    logging.warning("docker events auf %s: %s", ip, line.decode(errors="replace").strip())
+    finally:
+        ssh_pool.release(ip, chan)
+
+class ContainerWatcher:
+    def __init__(self):
+        self._watches = {}  # ip -> (container, stop, task)
+        self.connected = {}  # ip -> container, solange der Stream steht
+        self.running = {}  # ip -> True/False/None (None = noch unbekannt, einmal pollen)
+
+    def is_watching(self, ip, container):
+        return self.connected.get(ip) == container
+
+    def state(self, ip, container):
+        return self.running.get(ip) if self.is_watching(ip, container) else None
+
+    def sync(self):
+        # Watches an die aktuellen Einstellungen anpassen
+        wanted = {
+            ip: srv["container"] for ip, srv in get_all_servers().items()
+            if srv.get("container") and srv.get("watch", DOCKER_EVENTS_WATCH)
+        }
+        for ip, (container, _, _) in list(self._watches.items()):
+            if wanted.get(ip) != container:
+                self.stop(ip)
+        for ip, container in wanted.items():
+            if ip not in self._watches:
+                stop = threading.Event()
+                self._watches[ip] = (container, stop, asyncio.create_task(self._run(ip, container, stop)))
+
+    def stop(self, ip):
+        watch = self._watches.pop(ip, None)
+        self.connected.pop(ip, None)
+        self.running.pop(ip, None)
+        if watch:
+            watch[1].set()
+            watch[2].cancel()
+
+    def stop_all(self):
+        for ip in list(self._watches):
+            self.stop(ip)
+
+    async def _run(self, ip, container, stop):
+        loop = asyncio.get_running_loop()
+        backoff = 1
+        while not stop.is_set():
+            def on_event(event):
+                loop.call_soon_threadsafe(self._on_event, ip, container, event)
             try:
-                prune_output_folders(ip)
+                await run_in_thread(watch_docker_events, ip, container, stop, on_event)
             except Exception as e:
-                await app.bot.send_message(chat_id=TELEGRAM_CHAT_ID, text=f"Fehler beim Pruning: {e}")
-            # Servername holen
-            servers = get_all_servers()
-            name = servers.get(ip, {}).get('name', ip)
-            container = get_container(ip)
-            container_running = False
-            if container:
-                ps_out, _ = ssh_command(ip, f'docker ps --format "{{{{.Names}}}}"')
-                running_names = [n.strip() for n in ps_out.splitlines()]
-                if container in running_names:
-                    container_running = True
-                logs, _ = ssh_command(ip, f'docker logs --tail 20 {container}')
-                logs_html = logs.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("|", "&#124;")
-                logs_block = f"<b>docker logs {container} (letzte 20 Zeilen)</b>\n<pre>{logs_html}</pre>"
+                logging.info("docker events auf %s getrennt: %s", ip, e)
+            if self.connected.pop(ip, None):
+                backoff = 1
+            if stop.is_set():
+                break
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, WATCH_BACKOFF_MAX)
+
+    def _on_event(self, ip, container, event):
+        if ip not in self._watches:
+            return
+        if event is None:
+            self.connected[ip] = container
+            self.running[ip] = None
+            return
+        action = event.get("Action") or event.get("status") or ""
+        name = get_server_value(ip, 'name', ip)
+        if action.startswith("health_status"):
+            unhealthy = action.endswith("unhealthy")
+            result, _ = force_alert(ip, "health", unhealthy)
+            if result:
+                msg = container_alert_message("unhealthy" if unhealthy else "healthy", None, name, ip, container)
+                outbox.send(TELEGRAM_CHAT_ID, msg, 'HTML')
+            return
+        if action not in WATCH_EVENTS:
+            return
+        running = action == "start"
+        self.running[ip] = running
+        result, state = force_alert(ip, "container", not running)
+        if result:
+            outbox.send(TELEGRAM_CHAT_ID, container_alert_message(result, state, name, ip, container), 'HTML')
+
+container_watcher = ContainerWatcher()
+
+# /watch <name> on|off
+async def watch_command(update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args or len(context.args) < 2 or context.args[1] not in ("on", "off"):
+        await reply(update, "Bitte nutze: /watch <name|@tag|muster> on|off")
+        return
+    records = await resolve_servers(update, context.args[0].strip())
+    if not records:
+        return
+    for rec in records:
+        set_server_value(rec.ip, "watch", context.args[1] == "on")
+    container_watcher.sync()
+    msg = f"docker-events-Watch für {describe_servers(records)} {'aktiviert' if context.args[1] == 'on' else 'deaktiviert'}."
+    missing = [rec.name for rec in records if not rec.container]
+    if context.args[1] == "on" and missing:
+        msg += f"\nOhne Container (startet nach /sc): {', '.join(missing)}"
+    await reply(update, msg)
+
+
+# === Check-Scheduler ===
+CHECK_CONCURRENCY = int(os.getenv("CHECK_CONCURRENCY", "8"))  # max. gleichzeitige Checks
+CHECK_JITTER = float(os.getenv("CHECK_JITTER", "0.1"))  # zufällige Abweichung als Anteil des Intervalls
+CHECK_STARTUP_SPREAD = 10  # Sekunden, über die die ersten Checks nach dem Start verteilt werden
+
+# Ein Deadline-Heap für alle Server statt einer Endlosschleife pro Server. Der Heap kann
+# veraltete Einträge enthalten; maßgeblich ist self._due, alles andere wird übersprungen.
+class CheckScheduler:
+    def __init__(self, app, check, concurrency=CHECK_CONCURRENCY, jitter=CHECK_JITTER):
+        self.app = app
+        self.check = check
+        self.jitter = jitter
+        self._servers = set()
+        self._heap = []
+        self._due = {}
+        self._last_start = {}
+        self._tasks = {}
+        self._active = 0
+        self._seq = itertools.count()
+        self._sem = asyncio.Semaphore(concurrency)
+        self._wake = asyncio.Event()
+        self._loop_task = None
+        self.lag = 0.0
+
+    def _now(self):
+        return asyncio.get_running_loop().time()
+
+    def _push(self, ip, due):
+        self._due[ip] = due
+        heapq.heappush(self._heap, (due, next(self._seq), ip))
+        self._wake.set()
+
+    def _next_due(self, ip, start):
+        interval = effective_interval(ip)
+        return start + interval + random.uniform(-self.jitter, self.jitter) * interval
+
+    def add(self, ip, delay=None):
+        if delay is None:
+            # Fester Versatz pro Host, damit nicht alle Checks gleichzeitig starten
+            delay = (zlib.crc32(ip.encode()) % 1000) / 1000 * min(get_server_interval(ip), CHECK_STARTUP_SPREAD)
+        self._servers.add(ip)
+        if ip not in self._tasks:
+            self._push(ip, self._now() + delay)
+
+    def remove(self, ip):
+        self._servers.discard(ip)
+        self._due.pop(ip, None)
+        self._last_start.pop(ip, None)
+        task = self._tasks.pop(ip, None)
+        if task:
+            task.cancel()
+
+    def reschedule(self, ip):
+        # Nach /interval sofort mit dem neuen Wert planen, statt den alten Termin abzuwarten
+        if ip in self._servers and ip in self._due and ip in self._last_start:
+            self._push(ip, max(self._now(), self._next_due(ip, self._last_start[ip])))
+
+    @property
+    def in_flight(self):
+        return self._active
+
+    def due_times(self):
+        # Nächste Fälligkeiten als Wanduhrzeit, für den Warmstart
+        offset = time.time() - self._now()
+        return {ip: due + offset for ip, due in self._due.items()}
+
+    @property
+    def queue_depth(self):
+        # Fällige Checks, die noch auf einen freien Slot warten
+        return len(self._tasks) - self._active
+
+    @property
+    def scheduled(self):
+        return len(self._servers)
+
+    def start(self):
+        self._loop_task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        if self._loop_task:
+            tasks.append(self._loop_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            now = self._now()
+            while self._heap and self._heap[0][0] <= now:
+                due, _, ip = heapq.heappop(self._heap)
+                if self._due.get(ip) != due:
+                    continue
+                del self._due[ip]
+                self._tasks[ip] = asyncio.create_task(self._run_check(ip, due))
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_check(self, ip, due):
+        task = asyncio.current_task()
+        try:
+            async with self._sem:
+                self._active += 1
+                start = self._now()
+                self.lag = start - due
+                scheduler_lag_seconds.observe(max(self.lag, 0.0))
+                self._last_start[ip] = start
+                try:
+                    await self.check(self.app, ip)
+                except Exception:
+                    logging.exception("Check für %s fehlgeschlagen", ip)
+                finally:
+                    self._active -= 1
+        finally:
+            if self._tasks.get(ip) is task:
+                del self._tasks[ip]
+                if ip in self._servers:
+                    self._push(ip, self._next_due(ip, self._last_start.get(ip, self._now())))
+
+check_scheduler = None
+
+# === Check-Worker (Sharding) ===
+# Mit CHECK_WORKERS > 0 laufen die Probes nicht mehr im Bot-Prozess, sondern in K Worker-Prozessen
+# mit eigenem SSH-Pool. Der Bot behält Telegram, Einstellungen, Alarme und Cache und bekommt pro
+# Probe ein kompaktes Tupel zurück. Die Zuordnung Host → Worker per Consistent Hashing hält
+# Verbindungen und Log-Cursor warm: neue oder entfernte Hosts verschieben keine anderen.
+CHECK_WORKERS = int(os.getenv("CHECK_WORKERS", "0"))  # 0 = Probes im Bot-Prozess
+CHECK_WORKER_REPLICAS = 64  # virtuelle Knoten pro Worker auf dem Ring
+CHECK_WORKER_RESTART_MAX = 60  # Sekunden, höchste Wartezeit vor dem Neustart eines abgestürzten Workers
+
+class WorkerUnavailable(RuntimeError):
+    # Der Worker ist ausgefallen, nicht der Host: kein Grund für einen Offline-Alarm
+    pass
+
+class HashRing:
+    def __init__(self, nodes, replicas=CHECK_WORKER_REPLICAS):
+        self._ring = sorted((self._hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self._keys = [h for h, _ in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def node(self, key):
+        return self._ring[bisect.bisect(self._keys, self._hash(key)) % len(self._ring)][1]
+
+def check_worker(conn):
+    # Hauptschleife im Worker-Prozess: Aufträge lesen, im Thread-Pool ausführen, Ergebnis zurückschicken
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Strg+C beendet nur den Bot, der räumt die Worker ab
+    send_lock = threading.Lock()
+    funcs = {"check": check_probe, "probe": probe_server}
+
+    def run(req_id, op, args):
+        try:
+            if op == "forget":
+                ssh_pool.drop(args[0])
+                forget_log_cursors(args[0])
+                result = ("ok", None)
+            elif op == "connect":
+                ssh_pool.get(args[0])
+                result = ("ok", None)
             else:
-                logs_block = "<i>Kein Container gesetzt. Mit /sc &lt;name&gt; setzen.</i>"
-            if container and not container_running:
-                alert_msg = (
-                    f"<b>🚨 Container DOWN!</b>\n"
-                    f"<b>Container <code>{container}</code> läuft NICHT auf {name} ({ip})!</b>\n"
-                    f"Bitte prüfen!"
-                )
-                await app.bot.send_message(chat_id=TELEGRAM_CHAT_ID, text=alert_msg, parse_mode='HTML')
-            if get_periodic_running(ip):
-                msg = (
-                    f"<b>VServer {name} ({ip}) ist ONLINE</b>\n"
-                    f"<b>Uptime:</b> <code>{info}</code>\n\n"
-                    f"<b>docker ps</b>\n<pre>{docker_ps}</pre>\n"
-                    f"<b>df -h /dev/vdb</b>\n<pre>{df_vdb}</pre>\n"
-                    f"{logs_block}"
-                )
-                await app.bot.send_message(chat_id=TELEGRAM_CHAT_ID, text=msg, parse_mode='HTML')
+                result = ("ok", astuple(funcs[op](*args)))
+        except HostUnreachable as e:
+            result = ("unreachable", str(e))
         except Exception as e:
-            # Servername holen
-            servers = get_all_servers()
-            name = servers.get(ip, {}).get('name', ip)
-            msg = (
-                "<b>🚨🚨🚨 SERVER OFFLINE! 🚨🚨🚨</b>\n"
-                f"<b>VServer {name} ({ip}) ist OFFLINE!</b>\n"
-                f"<b>Fehler:</b> <code>{e}</code>\n"
-                "<b>BITTE SOFORT PRÜFEN!</b>"
+            result = ("error", str(e) or type(e).__name__)
+        with send_lock:
+            conn.send((req_id, *result))
+
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            break
+        if msg is None:
+            break
+        ssh_executor.submit(run, *msg)
+    ssh_executor.shutdown(wait=False, cancel_futures=True)
+    ssh_pool.close_all()
+
+class CheckWorkers:
+    def __init__(self, workers=CHECK_WORKERS):
+        self.workers = workers
+        self.ring = HashRing(range(workers))
+        self._conns = {}
+        self._procs = {}
+        self._started = {}
+        self._backoff = {}
+        self._pending = {}
+        self._seq = itertools.count()
+        self._loop = None
+        self._stopping = False
+        self.restarts = 0
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        for shard in range(self.workers):
+            self._spawn(shard)
+
+    def _spawn(self, shard):
+        # spawn statt fork: der Bot-Prozess hat schon Threads (SSH-Pool, Timer), die ein fork halb kopieren würde
+        ctx = multiprocessing.get_context("spawn")
+        parent, child = ctx.Pipe()
+        proc = ctx.Process(target=check_worker, args=(child,), name=f"check-worker-{shard}", daemon=True)
+        proc.start()
+        child.close()
+        self._conns[shard] = parent
+        self._procs[shard] = proc
+        self._started[shard] = time.monotonic()
+        threading.Thread(target=self._read, args=(shard, parent), name=f"check-worker-{shard}-reader", daemon=True).start()
+
+    def _read(self, shard, conn):
+        # Ein Lesethread pro Worker; Ergebnisse gehen per call_soon_threadsafe an die Event-Loop
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                break
+            try:
+                self._loop.call_soon_threadsafe(self._resolve, msg)
+            except RuntimeError:  # Event-Loop schon beendet
+                return
+        try:
+            self._loop.call_soon_threadsafe(self._worker_died, shard, conn)
+        except RuntimeError:
+            pass
+
+    def _resolve(self, msg):
+        req_id, status, payload = msg
+        entry = self._pending.pop(req_id, None)
+        if entry is None or entry[1].done():
+            return
+        future = entry[1]
+        if status == "ok":
+            future.set_result(payload)
+        elif status == "unreachable":
+            future.set_exception(HostUnreachable(payload))
+        else:
+            future.set_exception(RuntimeError(payload))
+
+    def _worker_died(self, shard, conn):
+        if self._conns.get(shard) is not conn:
+            return
+        for req_id, (owner, future) in list(self._pending.items()):
+            if owner == shard:
+                del self._pending[req_id]
+                if not future.done():
+                    future.set_exception(WorkerUnavailable(f"Check-Worker {shard} wurde beendet"))
+        if self._stopping:
+            return
+        # Wer gleich wieder stirbt, wird mit wachsendem Abstand neu gestartet
+        delay = self._backoff.get(shard, 0.5) * 2 if time.monotonic() - self._started[shard] < CHECK_WORKER_RESTART_MAX else 1
+        self._backoff[shard] = min(delay, CHECK_WORKER_RESTART_MAX)
+        logging.warning("Check-Worker %s beendet, Neustart in %.0f Sekunden", shard, self._backoff[shard])
+        self.restarts += 1
+        self._loop.call_later(self._backoff[shard], self._respawn, shard)
+
+    def _respawn(self, shard):
+        if not self._stopping:
+            self._spawn(shard)
+
+    def _submit(self, ip, op, args):
+        shard = self.ring.node(ip)
+        req_id = next(self._seq)
+        future = self._loop.create_future()
+        self._pending[req_id] = (shard, future)
+        try:
+            self._conns[shard].send((req_id, op, args))
+        except (OSError, ValueError) as e:
+            del self._pending[req_id]
+            future.set_exception(WorkerUnavailable(f"Check-Worker {shard} nicht erreichbar: {e}"))
+        return future
+
+    async def run(self, func, ip, *args):
+        op = "check" if func is check_probe else "probe"
+        return Snapshot(*await self._submit(ip, op, (ip, *args)))
+
+    def forget(self, ip):
+        # Ohne Warten; ein ausgefallener Worker hat den Host ohnehin vergessen
+        self._submit(ip, "forget", (ip,)).add_done_callback(lambda future: future.exception())
+
+    async def connect(self, ip):
+        await self._submit(ip, "connect", (ip,))
+
+    def pending(self, shard):
+        return sum(1 for owner, _ in self._pending.values() if owner == shard)
+
+    def assigned(self, servers):
+        counts = collections.Counter(self.ring.node(ip) for ip in servers)
+        return [counts.get(shard, 0) for shard in range(self.workers)]
+
+    async def stop(self):
+        self._stopping = True
+        for conn in self._conns.values():
+            try:
+                conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for proc in self._procs.values():
+            await asyncio.to_thread(proc.join, 5)
+            if proc.is_alive():
+                proc.kill()
+
+check_workers = None
+
+async def run_probe(func, ip, *args):
+    # func ist probe_server oder check_probe; mit Workern läuft sie auf dem zuständigen Shard
+    if check_workers:
+        try:
+            return await check_workers.run(func, ip, *args)
+        except WorkerUnavailable as e:
+            # Während der Worker neu startet, prüft der Bot-Prozess selbst
+            logging.debug("%s, prüfe %s im Bot-Prozess", e, ip)
+    return await run_ssh(func, ip, *args)
+
+# === Metrik-Historie ===
+# Numerische Probe-Ergebnisse landen in SQLite (out/history.db). Rohwerte werden
+# HISTORY_RAW_HOURS behalten und danach zu 5-Minuten-Mittelwerten verdichtet.
+HISTORY_FILE = "out/history.db"
+HISTORY_RAW_HOURS = int(os.getenv("HISTORY_RAW_HOURS", "24"))
+HISTORY_DAYS = int(os.getenv("HISTORY_DAYS", "180"))
+HISTORY_FLUSH_INTERVAL = 30  # Sekunden zwischen Schreibvorgängen
+HISTORY_ROLLUP = 300  # Sekunden pro verdichtetem Wert
+HISTORY_METRICS = ("load1", "load5", "load15", "disk", "container", "online", "latency")
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+class MetricsHistory:
+    def __init__(self, path=HISTORY_FILE):
+        self.path = path
+        self._db = None
+        self._pending = []
+        self._lock = threading.Lock()  # nur für _pending, damit record() in der Event-Loop nie auf SQLite wartet
+        self._db_lock = threading.Lock()
+        self._last_compact = 0.0
+
+    def _conn(self):
+        if self._db is None:
+            dirpath = os.path.dirname(self.path)
+            if dirpath:
+                os.makedirs(dirpath, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            for table in ("samples", "samples_5m"):
+                self._db.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} (ip TEXT, metric TEXT, ts INTEGER, value REAL, "
+                    "PRIMARY KEY (ip, metric, ts)) WITHOUT ROWID"
+                )
+        return self._db
+
+    def record(self, ip, values, ts=None):
+        ts = int(ts or time.time())
+        with self._lock:
+            self._pending.extend((ip, metric, ts, float(v)) for metric, v in values.items() if v is not None)
+
+    def record_snapshot(self, snap):
+        self.record(snap.ip, {
+            "load1": snap.load[0],
+            "load5": snap.load[1],
+            "load15": snap.load[2],
+            "disk": snap.disk_percent,
+            "container": snap.container_running(snap.container) if snap.container else None,
+            "online": 1,
+            "latency": snap.latency,
+        }, snap.taken_at)
+
+    def flush(self):
+        # Erst die DB sperren, dann tauschen: forget() kann so keine Zeilen verpassen, die gerade geschrieben werden
+        with self._db_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            db = self._conn()
+            if rows:
+                with db:
+                    db.executemany("INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?)", rows)
+            if time.time() - self._last_compact > 3600:
+                self._compact(db)
+
+    def _compact(self, db):
+        now = int(time.time())
+        cutoff = now - HISTORY_RAW_HOURS * 3600
+        cutoff -= cutoff % HISTORY_ROLLUP
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO samples_5m SELECT ip, metric, ts - ts % ?, avg(value) "
+                "FROM samples WHERE ts < ? GROUP BY ip, metric, ts - ts % ?",
+                (HISTORY_ROLLUP, cutoff, HISTORY_ROLLUP),
             )
-            await app.bot.send_message(chat_id=TELEGRAM_CHAT_ID, text=msg, parse_mode='HTML')
-        await asyncio.sleep(interval)
+            db.execute("DELETE FROM samples WHERE ts < ?", (cutoff,))
+            db.execute("DELETE FROM samples_5m WHERE ts < ?", (now - HISTORY_DAYS * 86400,))
+        self._last_compact = time.time()
+
+    def forget(self, ip):
+        with self._db_lock:
+            with self._lock:
+                self._pending = [r for r in self._pending if r[0] != ip]
+            db = self._conn()
+            with db:
+                for table in ("samples", "samples_5m"):
+                    db.execute(f"DELETE FROM {table} WHERE ip = ?", (ip,))
+
+    def query(self, ip, metric, since):
+        self.flush()
+        with self._db_lock:
+            return self._conn().execute(
+                "SELECT ts, value FROM samples_5m WHERE ip = ? AND metric = ? AND ts >= ? "
+                "UNION ALL SELECT ts, value FROM samples WHERE ip = ? AND metric = ? AND ts >= ? ORDER BY ts",
+                (ip, metric, since, ip, metric, since),
+            ).fetchall()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception:
+                logging.exception("Historie konnte nicht geschrieben werden")
+
+metrics_history = MetricsHistory()
+
+def parse_duration(text):
+    # "30m", "6h", "7d" -> Sekunden
+    m = re.fullmatch(r"(\d+)([smhd]?)", text.strip().lower())
+    if not m:
+        return None
+    return int(m.group(1)) * {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}[m.group(2)]
+
+def sparkline(rows, since, until, width=40):
+    # Werte in width gleich breite Zeitfenster mitteln; leere Fenster bleiben Leerzeichen
+    buckets = [[] for _ in range(width)]
+    span = max(until - since, 1)
+    for ts, value in rows:
+        buckets[min(int((ts - since) * width / span), width - 1)].append(value)
+    avgs = [sum(b) / len(b) if b else None for b in buckets]
+    present = [a for a in avgs if a is not None]
+    lo, hi = min(present), max(present)
+    scale = (len(SPARK_CHARS) - 1) / (hi - lo) if hi > lo else 0
+    return "".join(" " if a is None else SPARK_CHARS[int((a - lo) * scale)] for a in avgs)
+
+# /history <name> <metric> [zeitraum]
+async def history_command(update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args or len(context.args) < 2 or context.args[1] not in HISTORY_METRICS:
+        await reply(
+            update, f"Bitte nutze: /history <name> <{'|'.join(HISTORY_METRICS)}> [zeitraum, z.B. 6h oder 7d]"
+        )
+        return
+    name = context.args[0].strip()
+    metric = context.args[1]
+    span = parse_duration(context.args[2]) if len(context.args) > 2 else 86400
+    if not span:
+        await reply(update, "Ungültiger Zeitraum. Beispiele: 30m, 6h, 7d")
+        return
+    ip = await find_server_ip(update, name)
+    if not ip:
+        return
+    until = int(time.time())
+    since = until - span
+    rows = await asyncio.to_thread(metrics_history.query, ip, metric, since)
+    if not rows:
+        await reply(update, f"Keine Daten für {metric} auf {name} im gewählten Zeitraum.")
+        return
+    values = [v for _, v in rows]
+    msg = (
+        f"<b>{metric} auf {name} ({ip}), letzte {context.args[2] if len(context.args) > 2 else '24h'}</b>\n"
+        f"<code>{sparkline(rows, since, until)}</code>\n"
+        f"min {min(values):.2f} · max {max(values):.2f} · avg {sum(values) / len(values):.2f} · "
+        f"aktuell {values[-1]:.2f} ({len(values)} Werte)"
+    )
+    await reply(update, msg, parse_mode='HTML')
+
+
+# === Warmstart ===
+# Laufzeitzustand (letzte Snapshots, Alarm-Zustände, nächste Fälligkeiten, Log-Cursor-Positionen) wird alle
+# STATE_CHECKPOINT_INTERVAL Sekunden und beim Beenden nach out/state.json.gz geschrieben und beim
+# Start wieder geladen. So kommen nach einem Neustart weder doppelte Alarme noch ein Check-Burst.
+STATE_FILE = "out/state.json.gz"
+STATE_CHECKPOINT_INTERVAL = float(os.getenv("STATE_CHECKPOINT_INTERVAL", "60"))
+STATE_MAX_AGE = float(os.getenv("STATE_MAX_AGE", "86400"))  # älterer Zustand wird beim Start verworfen
+WARMUP_RATE = float(os.getenv("WARMUP_RATE", "20"))  # SSH-Verbindungen pro Sekunde beim Start
+STATE_VERSION = 1
+
+def collect_state():
+    # In der Event-Loop aufrufen, damit alles aus demselben Moment stammt
+    with log_cursors_lock:
+        cursors = [[ip, container, cursor.to_state()] for (ip, container), cursor in log_cursors.items()]
+    return {
+        "version": STATE_VERSION,
+        "saved_at": time.time(),
+        "snapshots": {ip: asdict(snap) for ip, snap in snapshot_cache.items()},
+        "alerts": [[ip, check, {k: getattr(st, k) for k in AlertState.__slots__}] for (ip, check), st in alert_states.items()],
+        "due": check_scheduler.due_times() if check_scheduler else {},
+        "cursors": cursors,
+    }
+
+def write_state(state, path=STATE_FILE):
+    payload = gzip.compress(json.dumps(state, separators=(",", ":")).encode(), compresslevel=6)
+    dirpath = os.path.dirname(path)
+    if dirpath:
+        os.makedirs(dirpath, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirpath or ".", prefix=".state.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def load_state(path=STATE_FILE):
+    try:
+        with open(path, "rb") as f:
+            state = json.loads(gzip.decompress(f.read()))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning("Zustand %s nicht lesbar, starte kalt: %s", path, e)
+        return None
+    age = time.time() - state.get("saved_at", 0)
+    if state.get("version") != STATE_VERSION or age > STATE_MAX_AGE:
+        logging.info("Zustand %s verworfen (Version %s, %.0f Sekunden alt)", path, state.get("version"), age)
+        return None
+    return state
+
+def restore_state(state, servers):
+    # Übernimmt nur Einträge für noch eingetragene Server; liefert die Fälligkeiten (Wanduhrzeit).
+    # Passt der Inhalt nicht (z.B. nach Änderungen an Snapshot), startet der Bot kalt.
+    try:
+        return _restore_state(state, servers)
+    except Exception as e:
+        logging.warning("Zustand %s nicht verwendbar, starte kalt: %s", STATE_FILE, e)
+        snapshot_cache.clear()
+        alert_states.clear()
+        with log_cursors_lock:
+            log_cursors.clear()
+        return {}
+
+def _restore_state(state, servers):
+    for ip, data in state.get("snapshots", {}).items():
+        if ip in servers:
+            data["load"] = tuple(data["load"])
+            data["timed_out"] = tuple(data.get("timed_out", ()))
+            snapshot_cache[ip] = Snapshot(**data)
+    for ip, check, data in state.get("alerts", []):
+        if ip in servers:
+            st = alert_states[(ip, check)] = AlertState()
+            for key, value in data.items():
+                setattr(st, key, value)
+    with log_cursors_lock:
+        for ip, container, data in state.get("cursors", []):
+            if ip in servers:
+                log_cursors[(ip, container)] = LogCursor.from_state(data)
+    logging.info("Warmstart: %d Snapshots, %d Alarm-Zustände, %d Log-Cursor aus %s",
+                 len(snapshot_cache), len(alert_states), len(log_cursors), STATE_FILE)
+    return {ip: float(due) for ip, due in state.get("due", {}).items() if ip in servers}
+
+async def checkpoint_state():
+    while True:
+        await asyncio.sleep(STATE_CHECKPOINT_INTERVAL)
+        try:
+            await asyncio.to_thread(write_state, collect_state())
+        except Exception:
+            logging.exception("Zustand konnte nicht gespeichert werden")
+
+async def warm_up_connections(ips, rate=WARMUP_RATE):
+    # Verbindungen in Reihenfolge der Fälligkeit vorab aufbauen: höchstens rate pro Sekunde und
+    # höchstens die Hälfte der SSH-Threads, damit die ersten Checks nicht warten müssen
+    sem = asyncio.Semaphore(max(1, SSH_MAX_CONCURRENCY // 2))
+
+    async def connect(ip):
+        async with sem:
+            try:
+                if check_workers:
+                    await check_workers.connect(ip)
+                else:
+                    await run_ssh(ssh_pool.get, ip)
+            except Exception as e:
+                logging.debug("Warmstart: %s nicht erreichbar: %s", ip, e)
+
+    tasks = []
+    for ip in ips:
+        tasks.append(asyncio.create_task(connect(ip)))
+        await asyncio.sleep(1 / rate)
+    await asyncio.gather(*tasks)
+    logging.info("Warmstart: Verbindungsaufbau zu %d Hosts abgeschlossen", len(ips))
+
+# === Metrik-Exporter ===
+# Optionaler HTTP-Endpunkt /metrics für Prometheus. Werte aus Cache, Scheduler und Outbox
+# werden erst beim Abruf gelesen, die Zähler und Histogramme laufen ohnehin mit.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 = kein Exporter
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+OPENMETRICS_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PROMETHEUS_TEXT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _snapshot_values(attr):
+    def collect():
+        return [((ip,), getattr(snap, attr)) for ip, snap in list(snapshot_cache.items()) if getattr(snap, attr) is not None]
+    return collect
+
+def _container_states():
+    out = []
+    for rec in server_registry.all():
+        snap = snapshot_cache.get(rec.ip)
+        if rec.container and snap is not None:
+            out.append(((rec.ip, rec.container), int(snap.container_running(rec.container))))
+    return out
+
+def _single(func):
+    # Für Werte, die es erst nach dem Start von main() gibt
+    def collect():
+        value = func()
+        return [((), value)] if value is not None else []
+    return collect
+
+Gauge("uptimebot_server_info", "Name und Gruppe je Host", ["host", "name", "group"],
+      collect=lambda: [((rec.ip, rec.name, rec.group or ""), 1) for rec in server_registry.all()])
+Gauge("uptimebot_disk_size_bytes", "Größe von DISK_DEVICE beim letzten Check", ["host"], collect=_snapshot_values("disk_size"))
+Gauge("uptimebot_disk_used_bytes", "Belegt auf DISK_DEVICE beim letzten Check", ["host"], collect=_snapshot_values("disk_used"))
+Gauge("uptimebot_disk_avail_bytes", "Frei auf DISK_DEVICE beim letzten Check", ["host"], collect=_snapshot_values("disk_avail"))
+Gauge("uptimebot_uptime_seconds", "Uptime des Hosts beim letzten Check", ["host"], collect=_snapshot_values("uptime_seconds"))
+Gauge("uptimebot_load1", "Load average (1 min) beim letzten Check", ["host"],
+      collect=lambda: [((ip,), snap.load[0]) for ip, snap in list(snapshot_cache.items())])
+Gauge("uptimebot_last_check_timestamp_seconds", "Zeitpunkt des letzten erfolgreichen Checks", ["host"], collect=_snapshot_values("taken_at"))
+Gauge("uptimebot_container_running", "1, wenn der überwachte Container läuft", ["host", "container"], collect=_container_states)
+Gauge("uptimebot_alerts_down", "Checks im Zustand DOWN",
+      collect=lambda: [((), sum(1 for a in list(alert_states.values()) if a.state == ALERT_DOWN))])
+Gauge("uptimebot_ssh_connections", "Offene Verbindungen im SSH-Pool", collect=lambda: [((), len(ssh_pool._clients))])
+Gauge("uptimebot_scheduler_servers", "Eingeplante Server", collect=_single(lambda: check_scheduler and check_scheduler.scheduled))
+Gauge("uptimebot_scheduler_in_flight", "Laufende Checks", collect=_single(lambda: check_scheduler and check_scheduler.in_flight))
+Gauge("uptimebot_scheduler_queue_depth", "Fällige Checks ohne freien Slot", collect=_single(lambda: check_scheduler and check_scheduler.queue_depth))
+Gauge("uptimebot_check_worker_pending", "Laufende Probes pro Check-Worker", ["worker"],
+      collect=lambda: [((str(shard),), check_workers.pending(shard)) for shard in range(check_workers.workers)] if check_workers else [])
+Gauge("uptimebot_outbox_depth", "Wartende Telegram-Nachrichten", collect=_single(lambda: outbox and outbox.depth))
+Counter("uptimebot_outbox_throttled", "Von Telegram gedrosselte Aufrufe (429)", collect=_single(lambda: outbox and outbox.throttled))
+Counter("uptimebot_outbox_failed", "Endgültig fehlgeschlagene Nachrichten", collect=_single(lambda: outbox and outbox.failed))
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(int(value))
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels.items():
+        value = _format_value(float(value)) if key == "le" else str(value)
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+def render_metrics(openmetrics=True):
+    lines = []
+    for metric in metric_families:
+        try:
+            samples = metric.samples()
+        except Exception:
+            logging.exception("Metrik %s konnte nicht gelesen werden", metric.name)
+            continue
+        # Im alten Textformat heißt die Familie eines Counters wie das Sample (mit _total)
+        family = metric.name if openmetrics or metric.kind != "counter" else metric.name + "_total"
+        lines.append(f"# HELP {family} {metric.help}")
+        lines.append(f"# TYPE {family} {metric.kind}")
+        for suffix, labels, value in samples:
+            lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+    if openmetrics:
+        lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics_request(reader, writer):
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        writer.close()
+        return
+    lines = head.decode("latin-1").split("\r\n")
+    method, path = (lines[0].split(" ") + ["", ""])[:2]
+    accept = next((line.split(":", 1)[1] for line in lines[1:] if line.lower().startswith("accept:")), "")
+    if method != "GET" or path.split("?", 1)[0] != "/metrics":
+        status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"Not Found\n"
+    else:
+        openmetrics = "application/openmetrics-text" in accept
+        status, body = "200 OK", render_metrics(openmetrics).encode()
+        content_type = OPENMETRICS_TYPE if openmetrics else PROMETHEUS_TEXT_TYPE
+    writer.write(
+        f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+        f"Connection: close\r\n\r\n".encode() + body
+    )
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    if not METRICS_PORT:
+        return None
+    server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+    logging.info("Metriken unter http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return server
+
+# === /stats Command ===
+async def stats_command(update, context: ContextTypes.DEFAULT_TYPE):
+    msg = (
+        "<b>Scheduler</b>\n"
+        f"Eingeplante Server: {check_scheduler.scheduled}\n"
+        f"Laufende Checks: {check_scheduler.in_flight}/{CHECK_CONCURRENCY}\n"
+        f"Warteschlange: {check_scheduler.queue_depth}\n"
+        f"Verzögerung letzter Check: {check_scheduler.lag:.1f} Sekunden\n"
+        f"Aktive Alarme: {sum(1 for a in alert_states.values() if a.state == ALERT_DOWN)}\n\n"
+        "<b>Outbox</b>\n"
+        f"Wartende Nachrichten: {outbox.depth}\n"
+        f"Gedrosselt (429): {outbox.throttled}\n"
+        f"Fehlgeschlagen: {outbox.failed}\n"
+    )
+    if check_workers:
+        assigned = check_workers.assigned(get_all_servers())
+        msg += f"\n<b>Check-Worker</b> (Neustarts: {check_workers.restarts})\n" + "\n".join(
+            f"Worker {shard}: {count} Server, {check_workers.pending(shard)} laufend" for shard, count in enumerate(assigned)
+        )
+    await reply(update, msg, parse_mode='HTML')
 
 # === /help Command ===
 
 async def interval_command(update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or len(context.args) < 2 or not context.args[1].isdigit():
-        await update.message.reply_text("Bitte nutze: /interval <name> <sekunden>")
+        await reply(update, "Bitte nutze: /interval <name|@tag|muster> <sekunden>")
         return
-    name = context.args[0].strip()
     seconds = int(context.args[1])
     if seconds < 10:
-        await update.message.reply_text("Das Intervall muss mindestens 10 Sekunden betragen.")
+        await reply(update, "Das Intervall muss mindestens 10 Sekunden betragen.")
         return
-    servers = get_all_servers()
-    ip = next((ip for ip, srv in servers.items() if srv.get('name') == name), None)
-    if not ip:
-        await update.message.reply_text(f"Kein VServer mit Name '{name}' gefunden.")
+    records = await resolve_servers(update, context.args[0].strip())
+    if not records:
         return
-    set_server_interval(ip, seconds)
-    await update.message.reply_text(f"Intervall für {name} wurde auf {seconds} Sekunden gesetzt.")
+    for rec in records:
+        set_server_interval(rec.ip, seconds)
+        check_scheduler.reschedule(rec.ip)
+    await reply(update, f"Intervall für {describe_servers(records)} wurde auf {seconds} Sekunden gesetzt.")
 
 async def help_command(update, context: ContextTypes.DEFAULT_TYPE):
     msg = (
         "<b>🛠️ VServer UptimeBot Hilfe</b>\n\n"
         "<b>🔹 Allgemein</b>\n"
         "/help – Zeigt diese Hilfe\n"
-        "/list – Zeigt alle eingetragenen Server\n\n"
+        "/list – Zeigt alle eingetragenen Server\n"
+        "/stats – Zeigt Auslastung des Check-Schedulers\n"
+        "/history &lt;name&gt; &lt;metrik&gt; [zeitraum] – Verlauf als Sparkline (load1/5/15, disk, container, online, latency)\n\n"
         "<b>➕ Serververwaltung</b>\n"
-        "/add &lt;ip&gt; &lt;name&gt; – Server hinzufügen und Überwachung starten\n"
-        "/remove &lt;ip&gt; – Server entfernen (nach IP)\n\n"
+        "/add &lt;ip&gt; &lt;name&gt; – Server hinzufügen und Überwachung starten (Name eindeutig, ohne Leerzeichen)\n"
+        "/remove &lt;ip&gt; – Server entfernen (nach IP)\n"
+        "/group &lt;auswahl&gt; &lt;gruppe&gt; – Ordnet Server einer Gruppe zu\n"
+        "/tag &lt;auswahl&gt; +tag -tag – Tags hinzufügen/entfernen\n\n"
         "<b>⚙️ Einstellungen</b>\n"
         "/settings – Zeigt Einstellungen aller Server\n"
-        "/settings &lt;name&gt; – Zeigt Einstellungen für einen Server\n"
-        "/interval &lt;name&gt; &lt;sekunden&gt; – Setzt das Prüfintervall für einen Server\n\n"
+        "/settings &lt;auswahl&gt; – Zeigt Einstellungen für die ausgewählten Server\n"
+        "/interval &lt;auswahl&gt; &lt;sekunden&gt; – Setzt das Prüfintervall\n\n"
         "<b>📦 Container</b>\n"
         "/sc &lt;name&gt; &lt;container&gt; – Setzt den Container für einen Server\n"
-        "/logs &lt;name&gt; &lt;container&gt; – Zeigt die letzten 2000 Zeilen Docker-Logs\n"
-        "/output &lt;name&gt; – Zeigt <code>ls -lh /mnt/output</code> für den Server\n\n"
+        "/watch &lt;auswahl&gt; on|off – Container-Ausfälle sofort über docker events melden\n"
+        "/logs &lt;name&gt; &lt;container&gt; – Zeigt die letzten Docker-Logs (nur neue Zeilen werden geladen)\n"
+        "/logs &lt;name&gt; &lt;container&gt; follow|stop – Live-Logs in einer mitlaufenden Nachricht\n"
+        "/logs &lt;name&gt; &lt;container&gt; full [zeilen|since] – Komplettes Log als .gz-Datei\n"
+        "/output &lt;name&gt; [size|mtime|name] [du] – Blättert durch das Output-Verzeichnis (du = mit Verzeichnisgrößen)\n\n"
         "<b>🔄 Status & Wartung</b>\n"
-        "/s &lt;name&gt; – Zeigt Status, Uptime, Container-Logs und Speicherplatz\n"
-        "/prune &lt;name&gt; – Prune output folders, wenn /dev/vdb &lt; 20G frei\n\n"
+        "/s &lt;name&gt; [!] – Zeigt Status, Uptime, Container-Logs und Speicherplatz (! = live statt Cache)\n"
+        "/s [auswahl] [!] – Prüft alle bzw. die ausgewählten Server parallel\n"
+        "/prune &lt;auswahl&gt; [dry|force] – Löscht alte Checkpoints, behält die neuesten Steps, "
+        f"nur wenn weniger als {PRUNE_MIN_FREE_GB:g}G frei sind (dry = nur Vorschau mit freiwerdendem Platz, "
+        "force = auch mit genug Platz). Automatisch bei wenig Platz\n\n"
         "<b>⏸️/▶️ Benachrichtigungen</b>\n"
-        "/stop &lt;name&gt; – Pausiert periodische Statusmeldungen für einen Server\n"
-        "/resume &lt;name&gt; – Setzt periodische Statusmeldungen für einen Server fort\n\n"
-        "<i>Alle Kommandos sind serverbasiert. Namen und Container müssen exakt wie eingetragen angegeben werden.</i>"
+        "/dashboard on|off [@gruppe] – Angepinnte Übersicht statt Statusmeldungen in jedem Intervall\n"
+        "/stop &lt;auswahl&gt; – Pausiert periodische Statusmeldungen\n"
+        "/resume &lt;auswahl&gt; – Setzt periodische Statusmeldungen fort\n\n"
+        "<i>Alle Kommandos sind serverbasiert. Namen und Container müssen exakt wie eingetragen angegeben werden. "
+        "&lt;auswahl&gt; ist ein Name, @gruppe bzw. @tag, container:&lt;container&gt;, ein Muster wie stage1-* "
+        "oder mehrere davon mit Komma.</i>"
     )
-    await update.message.reply_text(msg, parse_mode='HTML')
+    await reply(update, msg, parse_mode='HTML')
 
 # === /stop Command ===
 async def stop_command(update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or len(context.args) < 1:
-        await update.message.reply_text("Bitte nutze: /stop <name>")
+        await reply(update, "Bitte nutze: /stop <name|@tag|muster>")
         return
-    name = context.args[0].strip()
-    servers = get_all_servers()
-    ip = next((ip for ip, srv in servers.items() if srv.get('name') == name), None)
-    if not ip:
-        await update.message.reply_text(f"Kein VServer mit Name '{name}' gefunden.")
+    records = await resolve_servers(update, context.args[0].strip())
+    if not records:
         return
-    set_server_value(ip, "periodic_running", False)
-    await update.message.reply_text(f"Periodische Statusmeldungen für {name} gestoppt.")
+    for rec in records:
+        set_server_value(rec.ip, "periodic_running", False)
+    await reply(update, f"Periodische Statusmeldungen für {describe_servers(records)} gestoppt.")
 
 # === /resume Command ===
 async def resume_command(update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or len(context.args) < 1:
-        await update.message.reply_text("Bitte nutze: /resume <name>")
+        await reply(update, "Bitte nutze: /resume <name|@tag|muster>")
         return
-    name = context.args[0].strip()
-    servers = get_all_servers()
-    ip = next((ip for ip, srv in servers.items() if srv.get('name') == name), None)
-    if not ip:
-        await update.message.reply_text(f"Kein VServer mit Name '{name}' gefunden.")
+    records = await resolve_servers(update, context.args[0].strip())
+    if not records:
         return
-    set_server_value(ip, "periodic_running", True)
-    await update.message.reply_text(f"Periodische Statusmeldungen für {name} werden fortgesetzt.")
+    for rec in records:
+        set_server_value(rec.ip, "periodic_running", True)
+    await reply(update, f"Periodische Statusmeldungen für {describe_servers(records)} werden fortgesetzt.")
 
 
 # === Main für python-telegram-bot v22+ ===
 
-import logging
 logging.basicConfig(level=logging.INFO)
 
 # Fix für 'event loop is already running' unter Windows/Python 3.12 (z.B. in Jupyter, VSCode, etc.)
@@ -561,25 +3130,74 @@ async def main():
     app.add_handler(CommandHandler("remove", remove_command))
     app.add_handler(CommandHandler("list", list_command))
     app.add_handler(CommandHandler("sc", sc))
+    app.add_handler(CommandHandler("group", group_command))
+    app.add_handler(CommandHandler("tag", tag_command))
     app.add_handler(CommandHandler("s", s_command))
     app.add_handler(CommandHandler("logs", logs))
     app.add_handler(CommandHandler("output", output_command))
+    app.add_handler(CallbackQueryHandler(output_callback, pattern=r"^out\|"))
+    app.add_error_handler(error_handler)
     app.add_handler(CommandHandler("stop", stop_command))
     app.add_handler(CommandHandler("resume", resume_command))
     app.add_handler(CommandHandler("interval", interval_command))
     app.add_handler(CommandHandler("settings", settings_command))
     app.add_handler(CommandHandler("prune", prune_command))
+    app.add_handler(CommandHandler("stats", stats_command))
+    app.add_handler(CommandHandler("history", history_command))
+    app.add_handler(CommandHandler("watch", watch_command))
+    app.add_handler(CommandHandler("dashboard", dashboard_command))
 
-    # Für alle Server Tasks starten
-    global periodic_tasks
+    # Alle Server beim Scheduler einplanen
+    global check_scheduler, check_workers, outbox
+    outbox = Outbox(app.bot)
+    if CHECK_WORKERS > 0:
+        check_workers = CheckWorkers(CHECK_WORKERS)
+        check_workers.start()
+    # Mit Workern gilt CHECK_CONCURRENCY pro Worker-Prozess
+    check_scheduler = CheckScheduler(app, periodic_check_server, CHECK_CONCURRENCY * max(1, CHECK_WORKERS))
     servers = get_all_servers()
+    state = load_state()
+    due = restore_state(state, servers) if state else {}
     if not servers:
-        await app.bot.send_message(chat_id=TELEGRAM_CHAT_ID, text="Bitte füge einen Server mit /add <ip> <name> hinzu.")
+        outbox.send(TELEGRAM_CHAT_ID, "Bitte füge einen Server mit /add <ip> <name> hinzu.")
     else:
+        now = time.time()
         for ip in servers:
-            periodic_tasks[ip] = asyncio.create_task(periodic_check_server(app, ip))
+            # Gespeicherte Termine übernehmen; überfällige verteilt der Scheduler wie beim Kaltstart
+            check_scheduler.add(ip, delay=due[ip] - now if due.get(ip, 0) > now else None)
+    check_scheduler.start()
+    # Bekannt ausgefallene Hosts nicht vorab verbinden, die übrigen in Reihenfolge der Fälligkeit
+    down = {ip for (ip, check), st in alert_states.items() if check == "offline" and st.state == ALERT_DOWN}
+    warmup_task = asyncio.create_task(warm_up_connections(sorted(set(servers) - down, key=lambda ip: due.get(ip, 0))))
+    state_task = asyncio.create_task(checkpoint_state())
+    container_watcher.sync()
+    dashboards.start()
+    history_task = asyncio.create_task(metrics_history.run())
+    metrics_server = await start_metrics_server()
 
-    await app.run_polling()
+    try:
+        await app.run_polling()
+    finally:
+        if metrics_server:
+            metrics_server.close()
+        warmup_task.cancel()
+        state_task.cancel()
+        await check_scheduler.stop()
+        try:
+            write_state(collect_state())
+        except Exception:
+            logging.exception("Zustand konnte nicht gespeichert werden")
+        if check_workers:
+            await check_workers.stop()
+        container_watcher.stop_all()
+        dashboards.stop()
+        await outbox.close()
+        history_task.cancel()
+        metrics_history.flush()
+        ssh_executor.shutdown(wait=False, cancel_futures=True)
+        prune_executor.shutdown(wait=False, cancel_futures=True)
+        ssh_pool.close_all()
+        settings_store.flush()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file